@@ -1,18 +1,35 @@
+import sys
+import json
+
 from treebeard.admin import TreeAdmin
+from treebeard.exceptions import InvalidMoveToDescendant, InvalidPosition
 from treebeard.forms import movenodeform_factory
 
 import swapper
 
 from django import forms
 from django.urls import reverse
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseBadRequest, HttpResponseRedirect, HttpResponseNotAllowed, JsonResponse
+from django.core.exceptions import PermissionDenied
+from django.template.response import TemplateResponse
 from django.shortcuts import get_object_or_404
 from django.contrib import admin
 from django.conf.urls import url, include
 from django.views.generic import RedirectView
-from django.utils.translation import ugettext_lazy as _
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from django.utils.translation import ngettext, ugettext_lazy as _
 from django.contrib.admin.templatetags.admin_urls import add_preserved_filters
 
+from .cache import get_group_name, get_menu_data
+from .conf import settings
+from .instrumentation import instrument_view
+from .publish import publish_on_commit, unpublish_on_commit
+from .templatetags.plainmenu import tree_results
+from .tree import build_tree
+from .warm import warm_on_commit
+from .widgets import ParentAutocompleteInput
+
 Menu = swapper.load_model('plainmenu', 'Menu')
 MenuItem = swapper.load_model('plainmenu', 'MenuItem')
 Group = swapper.load_model('plainmenu', 'Group')
@@ -21,6 +38,48 @@ _menu_prefix = '{}_{}'.format(Menu._meta.app_label, Menu._meta.model_name)
 _menuitem_prefix = '{}_{}'.format(MenuItem._meta.app_label, MenuItem._meta.model_name)
 _group_prefix = '{}_{}'.format(Group._meta.app_label, Group._meta.model_name)
 
+#: number of items returned by the parent autocomplete
+PARENTS_LIMIT = 20
+
+#: label of "Child of" choice placing items at the top level
+ROOT_LABEL = _('-- root --')
+
+
+def _menu_changed(menu_id):
+    """ Republishes and rewarms the menu after commit, when enabled """
+    publish_on_commit(menu_id)
+    warm_on_commit(menu_id)
+
+
+def _int_param(value):
+    """ :returns: value of request parameter as int or None if it isn't a number """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_parent_choices(menu):
+    """
+    :returns: list of (pk, path, depth, title) of the menu's items in tree
+        order, loaded with one query and cached until the menu changes
+    """
+    def build():
+        items = MenuItem.objects.filter(menu=menu).order_by('path').only(
+            'menu', 'path', 'depth', 'sort_weight', 'title'
+        )
+        choices = []
+
+        def walk(items):
+            for item in items:
+                choices.append((item.pk, item.path, item.depth, item.title))
+                walk(item.children)
+
+        walk(build_tree(items))
+        return choices
+
+    return get_menu_data(menu, 'parent_choices', build)
+
 
 class MenuItemRedirectView(RedirectView):
     name = None
@@ -48,12 +107,13 @@ class MenuItemAdmin(TreeAdmin):
         if hasattr(request, '_current_tree_id'):
             queryset = queryset.filter(menu__pk=request._current_tree_id)
 
-        return queryset
+        return queryset.select_related('menu')
 
     @staticmethod
     def link_target(obj):
         return MenuItem.TARGET_CHOICES[obj.target]
 
+    @instrument_view('item_delete')
     def delete_view(self, request, menu_id, object_id, extra_context=None):
         request._current_tree_id = menu_id
         extra_context = extra_context or {}
@@ -62,14 +122,26 @@ class MenuItemAdmin(TreeAdmin):
 
         return super(MenuItemAdmin, self).delete_view(request, object_id, extra_context)
 
+    # urls are included under menu's url, every view gets menu_id
+    def add_view(self, request, menu_id, form_url='', extra_context=None):
+        return self.changeform_view(request, menu_id, None, form_url, extra_context)
+
+    def change_view(self, request, menu_id, object_id, form_url='', extra_context=None):
+        return self.changeform_view(request, menu_id, object_id, form_url, extra_context)
+
+    def history_view(self, request, menu_id, object_id, extra_context=None):
+        return super(MenuItemAdmin, self).history_view(request, object_id, extra_context)
+
+    @instrument_view('item_change')
     def changeform_view(self, request, menu_id=None, object_id=None, form_url=None, extra_context=None):
         if object_id and not menu_id:
             menu_id = object_id
             object_id = None
 
         request._current_tree_id = menu_id
+        request._current_menu = get_object_or_404(Menu.objects.select_related('group'), pk=menu_id)
         extra_context = extra_context or {}
-        extra_context['menu'] = get_object_or_404(Menu, pk=menu_id)
+        extra_context['menu'] = request._current_menu
         extra_context['menu_opts'] = Menu._meta
 
         return super(MenuItemAdmin, self).changeform_view(
@@ -79,6 +151,28 @@ class MenuItemAdmin(TreeAdmin):
             extra_context
         )
 
+    @instrument_view('item_move', id_arg=None)
+    def move_node(self, request):
+        node_id = _int_param(request.POST.get('node_id'))
+        if node_id is None or _int_param(request.POST.get('sibling_id')) is None:
+            return HttpResponseBadRequest('Malformed POST params')
+
+        response = super(MenuItemAdmin, self).move_node(request)
+
+        if response.status_code == 200 and (settings.PUBLISH_ON_SAVE or settings.WARM_ON_SAVE):
+            for menu_id in MenuItem.objects.filter(pk=node_id).values_list('menu_id', flat=True):
+                _menu_changed(menu_id)
+
+        return response
+
+    def save_model(self, request, obj, form, change):
+        super(MenuItemAdmin, self).save_model(request, obj, form, change)
+        _menu_changed(obj.menu_id)
+
+    def delete_model(self, request, obj):
+        super(MenuItemAdmin, self).delete_model(request, obj)
+        _menu_changed(obj.menu_id)
+
     def get_form(self, request, obj=None, **kwargs):
         ModelForm = super(MenuItemAdmin, self).get_form(request, obj, **kwargs)
 
@@ -102,20 +196,30 @@ class MenuItemAdmin(TreeAdmin):
 
                 self.fields['_ref_node_id'].label = 'Child of'
 
+                menu = getattr(request, '_current_menu', None)
+                limit = settings.ADMIN_PARENT_AUTOCOMPLETE
+                if menu is not None and limit is not None and len(get_parent_choices(menu)) > limit:
+                    url = reverse('admin:%s_parents' % _menu_prefix, args=(menu.pk,))
+                    labels = dict((pk, title) for pk, path, depth, title in get_parent_choices(menu))
+                    labels[0] = ROOT_LABEL
+                    self.fields['_ref_node_id'].widget = ParentAutocompleteInput(
+                        url, labels, attrs={'data-exclude': instance.pk if instance else ''}
+                    )
 
             @classmethod
             def mk_dropdown_tree(cls, model, for_node=None):
-                """ Creates a tree-like list of choices """
+                """ Creates a tree-like list of choices out of cached items of the current menu """
 
-                menu_id = getattr(request, '_current_tree_id', None)
-                queryset = model.get_root_nodes()
+                menu = getattr(request, '_current_menu', None)
+                if menu is None:
+                    return super(MyForm, cls).mk_dropdown_tree(model, for_node)
 
-                if menu_id:
-                    queryset = queryset.filter(menu__id=menu_id)
+                exclude = for_node.path if for_node is not None and for_node.path else None
+                options = [(0, ROOT_LABEL)]
 
-                options = [(0, _('-- root --'))]
-                for node in queryset:
-                    cls.add_subtree(for_node, node, options)
+                for pk, path, depth, title in get_parent_choices(menu):
+                    if exclude is None or not path.startswith(exclude):
+                        options.append((pk, mark_safe(cls.mk_indent(depth) + escape(title))))
                 return options
 
         return MyForm
@@ -152,12 +256,38 @@ class MenuAdmin(admin.ModelAdmin):
         return [
             url(r'^.+/move/$', self.admin_site.admin_view(self.menu_admin.move_node), ),
             url(r'^.+/jsi18n/$', JavaScriptCatalog.as_view(), {'packages': ('treebeard',)}),
-            url(r'^(\d+)/items/', include(self.menu_admin.get_urls())),
+            url(r'^(?P<menu_id>\d+)/items/', include(self.menu_admin.get_urls())),
+            url(r'^(\d+)/children/$', self.admin_site.admin_view(self.children_view), name='%s_children' % _menu_prefix),
+            url(r'^(\d+)/reorder/$', self.admin_site.admin_view(self.reorder_view), name='%s_reorder' % _menu_prefix),
+            url(r'^(\d+)/parents/$', self.admin_site.admin_view(self.parents_view), name='%s_parents' % _menu_prefix),
             url(r'^items/change/(.+)/', MenuItemRedirectView.as_view(name='%s_change' % _menuitem_prefix), name='%s_change' % _menuitem_prefix),
             url(r'^items/delete/(.+)/', MenuItemRedirectView.as_view(name='%s_delete' % _menuitem_prefix), name='%s_delete' % _menuitem_prefix),
             url(r'^items/changelist/', MenuItemRedirectView.as_view(name='%s_changelist' % _menu_prefix), name='%s_changelist' % _menuitem_prefix)
         ] + super(MenuAdmin, self).get_urls()
 
+    def save_model(self, request, obj, form, change):
+        previous = None
+        if change and settings.PUBLISH_ON_SAVE:
+            original = Menu.objects.select_related('group').filter(pk=obj.pk).first()
+            if original is not None:
+                previous = (original.identifier, get_group_name(original))
+
+        super(MenuAdmin, self).save_model(request, obj, form, change)
+        publish_on_commit(obj.pk, previous)
+        warm_on_commit(obj.pk)
+
+    def delete_model(self, request, obj):
+        identity = (obj.identifier, get_group_name(obj))
+        super(MenuAdmin, self).delete_model(request, obj)
+        unpublish_on_commit(*identity)
+
+    def delete_queryset(self, request, queryset):
+        identities = [(menu.identifier, get_group_name(menu)) for menu in queryset.select_related('group')]
+        super(MenuAdmin, self).delete_queryset(request, queryset)
+        for identity in identities:
+            unpublish_on_commit(*identity)
+
+    @instrument_view('menu_change')
     def change_view(self, request, object_id, form_url=u'', extra_context=None):
         request._current_tree_id = object_id
         extra_context = extra_context or {}
@@ -166,14 +296,106 @@ class MenuAdmin(admin.ModelAdmin):
 
         return super(MenuAdmin, self).change_view(request, object_id, form_url, extra_context)
 
-    def get_chagelist_instance(self, request):
+    def children_view(self, request, menu_id):
+        """ Renders tree rows of children of the item passed as ``node`` """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        node_id = _int_param(request.GET.get('node'))
+        if node_id is None:
+            return HttpResponseBadRequest('Malformed node')
+
+        request._current_tree_id = menu_id
+        parent = get_object_or_404(MenuItem, menu__pk=menu_id, pk=node_id)
+
+        return TemplateResponse(request, 'admin/plainmenu/tree_rows.html', {
+            'results': tree_results(self.get_chagelist_instance(request, parent), parent),
+        })
+
+    @instrument_view('menu_reorder', id_arg='menu_id')
+    def reorder_view(self, request, menu_id):
+        """
+        Applies many moves at once, accepts json ``{"items": [{"id": 1,
+        "parent": null, "position": 0}, ...]}`` and responds with every
+        item of the menu in the same format.
+        """
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+
+        menu = get_object_or_404(Menu, pk=menu_id)
+        if not self.has_change_permission(request, menu):
+            raise PermissionDenied
+
+        try:
+            moves = [
+                (
+                    int(move['id']),
+                    int(move['parent']) if move.get('parent') is not None else None,
+                    move.get('position'),
+                )
+                for move in json.loads(request.body.decode('utf-8'))['items']
+            ]
+            MenuItem.reorder(menu.pk, moves)
+        except (ValueError, KeyError, TypeError) as e:
+            return JsonResponse({'error': 'Malformed request: {}'.format(e)}, status=400)
+        except (MenuItem.DoesNotExist, InvalidMoveToDescendant, InvalidPosition) as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        _menu_changed(menu.pk)
+
+        items, ids, positions = [], {}, {}
+        for pk, path in MenuItem.objects.filter(menu=menu).order_by('path').values_list('pk', 'path'):
+            parent = ids.get(path[:-MenuItem.steplen])
+            ids[path] = pk
+            positions[parent] = positions.get(parent, -1) + 1
+            items.append({'id': pk, 'parent': parent, 'position': positions[parent]})
+
+        return JsonResponse({'items': items})
+
+    def parents_view(self, request, menu_id):
+        """ Searches items of the menu by title for the parent autocomplete """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        menu = get_object_or_404(Menu.objects.select_related('group'), pk=menu_id)
+        term = request.GET.get('term', '').lower()
+        exclude = None
+
+        choices = get_parent_choices(menu)
+        if request.GET.get('exclude'):
+            exclude = next((path for pk, path, depth, title in choices if str(pk) == request.GET['exclude']), None)
+
+        results = [
+            {'id': pk, 'text': '\u00a0' * 4 * (depth - 1) + title}
+            for pk, path, depth, title in choices
+            if term in title.lower() and (exclude is None or not path.startswith(exclude))
+        ]
+
+        # top level is always offered, it can't be found by title
+        return JsonResponse({'results': [{'id': 0, 'text': ROOT_LABEL}] + results[:PARENTS_LIMIT]})
+
+    def get_chagelist_instance(self, request, parent=None):
+        """
+        Changelist of the menu tree, lists children of parent or levels up
+        to ``PLAINMENU_ADMIN_EXPANDED_DEPTH``, whole tree when searching.
+        """
         ChangeList = self.menu_admin.get_changelist(request)
 
         class MyChangeList(ChangeList):
+            def get_queryset(self, request):
+                queryset = super(MyChangeList, self).get_queryset(request)
+
+                if parent is not None:
+                    return queryset.filter(path__startswith=parent.path, depth=parent.depth + 1)
+                elif not self.query:
+                    return queryset.filter(depth__lte=settings.ADMIN_EXPANDED_DEPTH)
+
+                return queryset
+
             def url_for_result(self, result):
                 return reverse(
                     'admin:{}_{}_change'.format(self.opts.app_label, self.opts.model_name),
-                    args=(result.menu.pk, admin.utils.quote(result.pk)),
+                    args=(result.menu_id, admin.utils.quote(result.pk)),
                     current_app=self.model_admin.admin_site.name
                 )
 
@@ -192,7 +414,8 @@ class MenuAdmin(admin.ModelAdmin):
             self.menu_admin.date_hierarchy,
             self.menu_admin.get_search_fields(request),
             self.menu_admin.get_list_select_related(request),
-            self.menu_admin.list_per_page,
+            # paging would cut subtrees, only expanded levels are listed instead
+            sys.maxsize,
             self.menu_admin.list_max_show_all,
             self.menu_admin.list_editable,
             self.menu_admin,
@@ -204,4 +427,36 @@ class MenuAdmin(admin.ModelAdmin):
         return cl
 
 
-admin.site.register(Group)
+def _copy_name(name, number, max_length):
+    """ :returns: name of the number-th copy, the original name is cut to fit max_length """
+    label = _('{} (copy)') if number == 1 else _('{} (copy {})')
+    copy_name = label.format(name, number)
+    if len(copy_name) > max_length:
+        copy_name = label.format(name[:max_length - len(copy_name)], number)
+
+    return copy_name
+
+
+@admin.register(Group)
+class GroupAdmin(admin.ModelAdmin):
+    actions = ['clone_groups']
+
+    def clone_groups(self, request, queryset):
+        names = set(Group.objects.values_list('name', flat=True))
+        max_length = Group._meta.get_field('name').max_length
+
+        for group in queryset.order_by('name'):
+            number = 1
+            name = _copy_name(group.name, number, max_length)
+            while name in names:
+                number += 1
+                name = _copy_name(group.name, number, max_length)
+
+            names.add(name)
+            group.clone(name)
+
+        count = len(queryset)
+        self.message_user(request, ngettext('%d group cloned', '%d groups cloned', count) % count)
+    clone_groups.short_description = _('Clone selected groups with their menus')
+    clone_groups.allowed_permissions = ('add',)
+
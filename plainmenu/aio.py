@@ -0,0 +1,42 @@
+"""
+Menu loading for async views, requires python 3 and asgiref (shipped
+with django 3.0+). The ORM is synchronous, so every function here makes
+a single worker thread call doing all of its queries::
+
+    async def view(request):
+        await aprefetch_menus(request, ['header', 'footer'], group='main')
+        return render(request, 'page.html')
+
+Templates rendered afterwards show prefetched menus without queries.
+"""
+from __future__ import unicode_literals
+
+from asgiref.sync import sync_to_async
+
+from .utils import get_menu, prefetch_menus, _load_pending
+
+
+async def aprefetch_menus(request, identifiers, group=None):
+    """
+    Same as :func:`~plainmenu.utils.prefetch_menus`, but trees of all
+    marked menus are loaded right away.
+    """
+    prefetch_menus(request, identifiers, group)
+
+    if getattr(request, '_plainmenu_pending', None):
+        await sync_to_async(_load_pending)(request)
+
+
+def _get_tree(menu_name, group_name, options):
+    menu = get_menu(menu_name, group_name)
+    return menu.get_tree(**options) if menu else []
+
+
+async def aget_tree(menu_name, group_name=None, **options):
+    """
+    Finds menu like :func:`~plainmenu.utils.get_menu` and loads its tree.
+
+    :param options: see :meth:`~plainmenu.models.AbstractMenu.get_tree`
+    :returns: tree of the menu, empty list if it is not found
+    """
+    return await sync_to_async(_get_tree)(menu_name, group_name, options)
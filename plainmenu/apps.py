@@ -0,0 +1,12 @@
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+
+
+class PlainmenuConfig(AppConfig):
+    name = 'plainmenu'
+
+    def ready(self):
+        from .cache import connect_signals
+
+        connect_signals()
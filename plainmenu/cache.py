@@ -0,0 +1,486 @@
+from __future__ import unicode_literals
+
+import time
+import uuid
+import hashlib
+
+import swapper
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.utils import translation
+
+from .conf import settings
+from .lru import LRUCache
+
+
+GENERATION_KEY = 'plainmenu:generation'
+
+
+def get_cache():
+    """ :returns: cache backend configured with ``PLAINMENU_CACHE`` or None """
+    if not settings.CACHE:
+        return None
+
+    return caches[settings.CACHE]
+
+
+def _make_key(prefix, *parts):
+    raw = '\0'.join('' if part is None else '{}'.format(part) for part in parts)
+    return 'plainmenu:{}:{}'.format(prefix, hashlib.md5(raw.encode('utf-8')).hexdigest())
+
+
+def version_key(identifier, group_name):
+    return _make_key('version', group_name, identifier)
+
+
+def content_key(identifier, group_name, template_name, language=None, variant=None):
+    """ :param variant: string telling apart renders of parts of the menu """
+    parts = (group_name, identifier, template_name, language or translation.get_language())
+    return _make_key('html', *(parts + (variant,) if variant is not None else parts))
+
+
+def rendered_variant(flavor=None, options=()):
+    """
+    :param flavor: ``'fast'`` for html of the fast renderer
+    :param options: list of (name, value) of partial menu options
+    :returns: variant of :func:`content_key` telling apart renders of the
+        same template, None for the whole menu rendered with the template engine
+    """
+    parts = ['renderer=fast'] if flavor == 'fast' else []
+    parts.extend('{}={!r}'.format(name, value) for name, value in options)
+    return ';'.join(parts) or None
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+def get_version(cache, identifier, group_name, values=None):
+    """
+    :returns: current version of the menu, combined from the menu's own
+        version and the global generation. Missing parts are created.
+    """
+    vkey = version_key(identifier, group_name)
+    _reset_bumped()
+
+    if values is None:
+        values = cache.get_many([GENERATION_KEY, vkey])
+
+    if GENERATION_KEY not in values or vkey not in values:
+        cache.add(GENERATION_KEY, _new_version(), None)
+        cache.add(vkey, _new_version(), None)
+        values = cache.get_many([GENERATION_KEY, vkey])
+
+    return values.get(GENERATION_KEY), values.get(vkey)
+
+
+def get_versions(pairs, request=None):
+    """
+    Fetches versions of many menus with a single ``get_many``.
+
+    Versions are remembered on the request, pass menus prefetched for the
+    page together with the requested one to fetch them all at once.
+
+    :param pairs: list of (identifier, group name)
+    :returns: dict of (identifier, group name) -> version
+    """
+    cache = get_cache()
+    if cache is None:
+        return {}
+
+    _reset_bumped()
+    versions = getattr(request, '_plainmenu_versions', None)
+    if versions is None:
+        versions = {}
+        if request is not None:
+            request._plainmenu_versions = versions
+
+    missing = set(pair for pair in pairs if pair not in versions)
+    if missing:
+        vkeys = dict((version_key(*pair), pair) for pair in missing)
+        keys = [GENERATION_KEY] + list(vkeys)
+        values = cache.get_many(keys)
+
+        if len(values) < len(keys):
+            for key in keys:
+                if key not in values:
+                    cache.add(key, _new_version(), None)
+            values = cache.get_many(keys)
+
+        for vkey, pair in vkeys.items():
+            versions[pair] = (values.get(GENERATION_KEY), values.get(vkey))
+
+    return versions
+
+
+_tree_cache = None
+
+
+def get_tree_cache():
+    """ :returns: per-process cache of menu trees or None if it is disabled """
+    global _tree_cache
+
+    if not settings.LRU_SIZE or get_cache() is None:
+        return None
+
+    if (
+        _tree_cache is None or
+        _tree_cache.max_entries != settings.LRU_SIZE or
+        _tree_cache.max_bytes != settings.LRU_MAX_BYTES
+    ):
+        _tree_cache = LRUCache(settings.LRU_SIZE, settings.LRU_MAX_BYTES)
+
+    return _tree_cache
+
+
+def get_rendered(identifier, group_name, template_name, variant=None, stale=False):
+    """
+    Looks up rendered menu in a single cache round trip.
+
+    :param stale: return html rendered for an older version of the menu
+        as the third item
+    :returns: tuple of (html or None, version to store fresh html with)
+    """
+    cache = get_cache()
+    if cache is None:
+        return (None, None, None) if stale else (None, None)
+
+    vkey = version_key(identifier, group_name)
+    ckey = content_key(identifier, group_name, template_name, variant=variant)
+    values = cache.get_many([GENERATION_KEY, vkey, ckey])
+    version = get_version(cache, identifier, group_name, values)
+
+    cached = values.get(ckey)
+    html = cached[1] if cached is not None and cached[0] == version else None
+
+    if stale:
+        return html, version, cached[1] if cached is not None and html is None else None
+
+    return html, version
+
+
+def acquire_rebuild(name, version):
+    """
+    Takes lock for building data of the given version, so only one worker
+    rebuilds it while others wait or serve the previous version.
+
+    :param name: tuple of strings telling apart the data, e.g. its cache key
+    :returns: lock key to release when done or None if it is taken
+    """
+    cache = get_cache()
+    if cache is None or version is None:
+        return None
+
+    key = _make_key('lock', *(name + tuple(version)))
+    return key if cache.add(key, 1, settings.REBUILD_LOCK_TIMEOUT) else None
+
+
+def release_rebuild(key):
+    if key is not None:
+        get_cache().delete(key)
+
+
+def wait_rendered(identifier, group_name, template_name, variant=None):
+    """
+    Polls the cache for html rebuilt by another worker for up to
+    ``PLAINMENU_REBUILD_WAIT`` seconds.
+
+    :returns: html or None if it didn't show up in time
+    """
+    deadline = time.time() + settings.REBUILD_WAIT
+
+    while time.time() < deadline:
+        time.sleep(0.05)
+
+        html = get_rendered(identifier, group_name, template_name, variant)[0]
+        if html is not None:
+            return html
+
+    return None
+
+
+def set_rendered(identifier, group_name, template_name, version, html, variant=None):
+    cache = get_cache()
+    if cache is None or version is None:
+        return
+
+    cache.set(
+        content_key(identifier, group_name, template_name, variant=variant),
+        (version, html),
+        settings.CACHE_TIMEOUT
+    )
+
+
+def data_key(identifier, group_name, name):
+    """ :param name: string or tuple of strings """
+    return _make_key('data', group_name, identifier, *(name if isinstance(name, tuple) else (name,)))
+
+
+def get_data(identifier, group_name, names, version=None):
+    """
+    Looks up values stored for the current version of the menu in a single
+    cache round trip, the version is fetched too unless passed.
+
+    :returns: tuple of (dict of name -> value of found names, version to
+        store fresh values with)
+    """
+    cache = get_cache()
+    if cache is None:
+        return {}, None
+
+    keys = dict((data_key(identifier, group_name, name), name) for name in names)
+
+    if version is None:
+        vkey = version_key(identifier, group_name)
+        values = cache.get_many([GENERATION_KEY, vkey] + list(keys))
+        version = get_version(cache, identifier, group_name, values)
+    else:
+        values = cache.get_many(list(keys))
+
+    found = dict(
+        (keys[key], value[1]) for key, value in values.items()
+        if key in keys and value[0] == version
+    )
+    return found, version
+
+
+def set_data(identifier, group_name, version, values):
+    """ Stores dict of name -> value for the version of the menu """
+    cache = get_cache()
+    if cache is None or version is None:
+        return
+
+    cache.set_many(
+        dict((data_key(identifier, group_name, name), (version, value)) for name, value in values.items()),
+        settings.CACHE_TIMEOUT
+    )
+
+
+#: data names of the link index with root paths and of the json tree
+LAYOUT = ('layout',)
+JSON = ('json',)
+
+
+def layout_values(items, index):
+    """ :returns: data of link index and root paths with frozen subtree of every root """
+    values = {LAYOUT: (index, tuple(item.path for item in items))}
+    for item in items:
+        values[('subtree', item.path)] = item
+
+    return values
+
+
+def get_menu_data(menu, name, build):
+    """
+    :returns: value built by ``build()``, cached until the menu changes
+        when cache is enabled
+    """
+    if get_cache() is None:
+        return build()
+
+    identifier, group_name = menu.identifier, get_group_name(menu)
+    found, version = get_data(identifier, group_name, [name])
+    if name in found:
+        return found[name]
+
+    value = build()
+    set_data(identifier, group_name, version, {name: value})
+
+    return value
+
+
+def _bump(keys):
+    cache = get_cache()
+    if cache is None:
+        return
+
+    cache.set_many(dict((key, _new_version()) for key in keys), None)
+
+
+def _bump_now_and_on_commit(keys):
+    _bump(keys)
+
+    # requests running while the transaction is open may cache old content
+    # with the new version, bump once more when the changes become visible
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _bump(keys))
+
+
+def _menu_keys(identifier, group_name):
+    keys = [version_key(identifier, group_name)]
+
+    if group_name is None:
+        # menus without group are also shown for unknown group names
+        keys.append(GENERATION_KEY)
+
+    return keys
+
+
+def invalidate(identifier, group_name):
+    """ Bumps version of the menu found by identifier within named group """
+    if get_cache() is None:
+        return
+
+    _bump_now_and_on_commit(_menu_keys(identifier, group_name))
+
+
+def invalidate_all():
+    if get_cache() is None:
+        return
+
+    _bump_now_and_on_commit([GENERATION_KEY])
+
+
+def invalidate_menu(menu):
+    if get_cache() is None:
+        return
+
+    invalidate(menu.identifier, get_group_name(menu))
+
+
+def invalidate_menu_id(menu_id):
+    """ Same as :func:`invalidate_menu`, the menu is only fetched with cache enabled """
+    if get_cache() is None:
+        return
+
+    menu = swapper.load_model('plainmenu', 'Menu').objects.select_related('group').filter(pk=menu_id).first()
+    if menu is not None:
+        invalidate_menu(menu)
+
+
+def get_group_name(menu):
+    return menu.group.name if menu.group_id else None
+
+
+class _PendingMenus(dict):
+    """
+    Menu pk -> version keys of menus with items changed in the current
+    transaction, called on commit to bump them all at once.
+    """
+
+    def __init__(self):
+        super(_PendingMenus, self).__init__()
+        # menus bumped since versions were last read, changes to them can't be cached yet
+        self.bumped = set()
+
+    def __call__(self):
+        _bump(set(key for keys in self.values() for key in keys))
+
+
+def _get_pending(connection, create=False):
+    pending = getattr(connection, '_plainmenu_pending', None)
+
+    # hooks of rolled back or committed transactions are gone with their menus
+    if pending is not None and not any(hook[1] is pending for hook in connection.run_on_commit):
+        pending = None
+
+    if pending is None and create:
+        pending = connection._plainmenu_pending = _PendingMenus()
+        transaction.on_commit(pending, using=connection.alias)
+
+    return pending
+
+
+def _reset_bumped():
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        pending = _get_pending(connection)
+        if pending is not None:
+            pending.bumped.clear()
+
+
+def _menu_pre_save(sender, instance, **kwargs):
+    if instance.pk:
+        instance._plainmenu_original = sender.objects.filter(pk=instance.pk).first()
+
+
+def _deleted_menus(using):
+    """ :returns: set of pks of menus being deleted, their items are left to the menu's own invalidation """
+    connection = transaction.get_connection(using)
+    if not hasattr(connection, '_plainmenu_deleted_menus'):
+        connection._plainmenu_deleted_menus = set()
+
+    return connection._plainmenu_deleted_menus
+
+
+def _menu_pre_delete(sender, instance, using, **kwargs):
+    _deleted_menus(using).add(instance.pk)
+
+
+def _menu_changed(sender, instance, signal, **kwargs):
+    if signal is post_delete:
+        _deleted_menus(kwargs['using']).discard(instance.pk)
+
+    original = getattr(instance, '_plainmenu_original', None)
+    if original is not None:
+        invalidate_menu(original)
+
+    invalidate_menu(instance)
+
+
+def _item_changed(sender, instance, using, **kwargs):
+    menu_id = instance.menu_id
+    if menu_id in _deleted_menus(using):
+        return
+
+    connection = transaction.get_connection(using)
+
+    if not connection.in_atomic_block:
+        invalidate_menu_id(menu_id)
+        return
+
+    pending = _get_pending(connection, create=True)
+    if menu_id not in pending:
+        menu = swapper.load_model('plainmenu', 'Menu').objects.select_related('group').filter(pk=menu_id).first()
+        pending[menu_id] = _menu_keys(menu.identifier, get_group_name(menu)) if menu is not None else []
+
+    if menu_id not in pending.bumped:
+        pending.bumped.add(menu_id)
+        _bump(pending[menu_id])
+
+
+def _group_changed(sender, instance, **kwargs):
+    invalidate_all()
+
+
+def _receivers():
+    Menu = swapper.load_model('plainmenu', 'Menu')
+    MenuItem = swapper.load_model('plainmenu', 'MenuItem')
+    Group = swapper.load_model('plainmenu', 'Group')
+
+    return [
+        (pre_save, _menu_pre_save, Menu, 'plainmenu_menu_pre_save'),
+        (post_save, _menu_changed, Menu, 'plainmenu_menu_save'),
+        (pre_delete, _menu_pre_delete, Menu, 'plainmenu_menu_pre_delete'),
+        (post_delete, _menu_changed, Menu, 'plainmenu_menu_delete'),
+        (post_save, _item_changed, MenuItem, 'plainmenu_item_save'),
+        (post_delete, _item_changed, MenuItem, 'plainmenu_item_delete'),
+        (post_save, _group_changed, Group, 'plainmenu_group_save'),
+        (post_delete, _group_changed, Group, 'plainmenu_group_delete'),
+    ]
+
+
+def connect_signals():
+    """
+    Connects receivers invalidating cached menus when ``PLAINMENU_CACHE``
+    is set. They are left out otherwise, so deletes of menu items keep
+    django's fast delete.
+    """
+    enabled = get_cache() is not None
+
+    for signal, receiver, sender, dispatch_uid in _receivers():
+        if enabled:
+            signal.connect(receiver, sender=sender, dispatch_uid=dispatch_uid)
+        else:
+            signal.disconnect(receiver, sender=sender, dispatch_uid=dispatch_uid)
+
+
+def _setting_changed(setting, **kwargs):
+    if setting == 'PLAINMENU_CACHE':
+        connect_signals()
+
+
+setting_changed.connect(_setting_changed, dispatch_uid='plainmenu_setting_changed')
@@ -0,0 +1,44 @@
+from __future__ import unicode_literals
+
+from django.conf import settings as django_settings
+
+
+DEFAULTS = {
+    # alias of the django cache used for rendered menus, None disables caching
+    'CACHE': None,
+    'CACHE_TIMEOUT': 60 * 60 * 24,
+    # number of menu trees kept in process memory, 0 disables, needs CACHE
+    'LRU_SIZE': 0,
+    'LRU_MAX_BYTES': 16 * 1024 * 1024,
+    # seconds a worker may spend rebuilding a menu while others serve its previous version
+    'REBUILD_LOCK_TIMEOUT': 30,
+    # seconds to wait for a menu rebuilt by another worker when no previous version is cached
+    'REBUILD_WAIT': 1,
+    # rebuild cache of menus changed in admin right away, needs CACHE
+    'WARM_ON_SAVE': False,
+    # 'fast' renders default menu markup without the template engine
+    'RENDERER': 'template',
+    # item fields used by custom menu templates, loaded with the default ones, '__all__' loads every field
+    'RENDER_EXTRA_FIELDS': (),
+    # levels of the admin menu tree rendered upfront, deeper ones are loaded on expand
+    'ADMIN_EXPANDED_DEPTH': 1,
+    # menus with more items get autocomplete instead of "Child of" dropdown, None disables
+    'ADMIN_PARENT_AUTOCOMPLETE': None,
+    # directory of menus pre-rendered by publish_menus command, see plainmenu.publish
+    'PUBLISH_DIR': None,
+    # publish menus changed in admin right away, needs PUBLISH_DIR
+    'PUBLISH_ON_SAVE': False,
+}
+
+
+class Settings(object):
+    """ Reads ``PLAINMENU_*`` django settings lazily, falling back to defaults """
+
+    def __getattr__(self, name):
+        if name not in DEFAULTS:
+            raise AttributeError(name)
+
+        return getattr(django_settings, 'PLAINMENU_' + name, DEFAULTS[name])
+
+
+settings = Settings()
@@ -0,0 +1,113 @@
+from __future__ import unicode_literals
+
+import time
+import inspect
+import logging
+from functools import wraps
+from contextlib import contextmanager
+
+from django.db import connections
+
+from .signals import admin_view_rendered
+
+
+logger = logging.getLogger('plainmenu.instrumentation')
+
+
+class QueryCounter(object):
+    """ Database execute wrapper counting queries and time spent in them """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+
+def is_enabled(signal):
+    return signal.has_listeners() or logger.isEnabledFor(logging.DEBUG)
+
+
+@contextmanager
+def measure(signal, **info):
+    """
+    Measures queries and time of the block and reports them with the signal
+    and ``plainmenu.instrumentation`` logger. Does nothing when neither has
+    listeners.
+
+    Yields stats dict the block may add own values to.
+    """
+    stats = {}
+
+    if not is_enabled(signal):
+        yield stats
+        return
+
+    counter = QueryCounter()
+    wrapped = []
+    for connection in connections.all():
+        connection.execute_wrappers.append(counter)
+        wrapped.append(connection)
+
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats['time'] = time.perf_counter() - start
+
+        for connection in wrapped:
+            connection.execute_wrappers.remove(counter)
+
+        stats['queries'] = counter.queries
+        stats['db_time'] = counter.db_time
+
+        signal.send(sender=None, stats=stats, **info)
+        logger.debug('%s %s', info, stats, extra={'plainmenu': dict(info, **stats)})
+
+
+@contextmanager
+def measure_render(stats):
+    """ Adds time spent in the block to ``render_time`` of stats """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats['render_time'] = stats.get('render_time', 0.0) + time.perf_counter() - start
+
+
+def instrument_view(name, id_arg='object_id'):
+    """
+    Decorates admin view method to be measured, template responses are rendered in place.
+
+    :param id_arg: name of the view argument reported as ``object_id``,
+        None for views without one
+    """
+
+    def decorator(view):
+        signature = inspect.signature(view)
+
+        @wraps(view)
+        def wrapper(self, request, *args, **kwargs):
+            if not is_enabled(admin_view_rendered):
+                return view(self, request, *args, **kwargs)
+
+            object_id = None
+            if id_arg is not None:
+                object_id = signature.bind_partial(self, request, *args, **kwargs).arguments.get(id_arg)
+
+            with measure(admin_view_rendered, view=name, object_id=object_id):
+                response = view(self, request, *args, **kwargs)
+                if hasattr(response, 'render') and not response.is_rendered:
+                    response.render()
+
+            return response
+
+        return wrapper
+
+    return decorator
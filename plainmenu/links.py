@@ -0,0 +1,82 @@
+from __future__ import unicode_literals
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # python 2
+    from urlparse import urlsplit
+
+
+def normalize_link(link):
+    """
+    :returns: link reduced to its path with trailing slash, query and
+        fragment are dropped, links to other hosts keep ``//host`` so they
+        never match paths of local pages. Empty links give None.
+    """
+    if not link:
+        return None
+
+    parts = urlsplit(link)
+    path = parts.path or '/'
+    if not path.endswith('/'):
+        path += '/'
+
+    if parts.netloc:
+        return '//' + parts.netloc + path
+
+    return path
+
+
+def link_index(items):
+    """
+    :returns: dict of normalized link -> path of the first item with such
+        link in tree order, works for items with attached ``children``
+    """
+    index = {}
+
+    def walk(items):
+        for item in items:
+            link = normalize_link(item.link)
+            if link is not None and link not in index:
+                index[link] = item.path
+            walk(item.children)
+
+    walk(items)
+    return index
+
+
+def candidate_links(url):
+    """
+    :returns: list of normalized url followed by its parent urls, closest
+        first, the site root is a candidate only for itself
+    """
+    candidates = []
+    link = normalize_link(url)
+
+    while link:
+        candidates.append(link)
+
+        link = link[:link.rstrip('/').rfind('/') + 1]
+        if link in ('/', '//'):
+            break
+
+    return candidates
+
+
+def find_active(index, url):
+    """
+    :returns: path of the item linking to url, or to its closest parent
+        url except the site root, None if there is none
+    """
+    for link in candidate_links(url):
+        if link in index:
+            return index[link]
+
+    return None
+
+
+def get_active_paths(path, steplen):
+    """ :returns: set of paths of the item and its ancestors """
+    if path is None:
+        return set()
+
+    return set(path[:end] for end in range(steplen, len(path) + 1, steplen))
@@ -0,0 +1,71 @@
+from __future__ import unicode_literals
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process cache of versioned values.
+
+    Bounded by number of entries and by total approximate size in bytes,
+    least recently used entries are dropped first.
+    """
+
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def get(self, key, version):
+        """ :returns: stored value if it was stored with the same version or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            if entry[0] != version:
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, version, value, size=0):
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (version, value, size)
+            self.size += size
+
+            while len(self._entries) > self.max_entries or (self.max_bytes and self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key)[2]
@@ -0,0 +1,30 @@
+from __future__ import unicode_literals
+
+import swapper
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class MenusCommand(BaseCommand):
+    """ Command over menus selected by pks and group name """
+    # verb for help of the --group argument
+    action = 'process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('menus', nargs='*', type=int, help='pks of menus, all menus by default')
+        parser.add_argument('--group', help='{} only menus of the group with this name'.format(self.action))
+
+    def get_menus(self, options):
+        """ :returns: queryset of selected menus, raises CommandError for pks not found """
+        Menu = swapper.load_model('plainmenu', 'Menu')
+
+        menus = Menu.objects.select_related('group').order_by('pk')
+        if options['menus']:
+            menus = menus.filter(pk__in=options['menus'])
+            missing = set(options['menus']) - set(menu.pk for menu in menus)
+            if missing:
+                raise CommandError('Menus not found: {}'.format(', '.join(str(pk) for pk in sorted(missing))))
+        if options['group']:
+            menus = menus.filter(group__name=options['group'])
+
+        return menus
@@ -0,0 +1,22 @@
+from __future__ import unicode_literals
+
+from plainmenu.management.base import MenusCommand
+from plainmenu.transfer import export_menus
+
+
+class Command(MenusCommand):
+    help = 'Exports menus with their item trees as json lines.'
+    action = 'export'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--output', '-o', help='file to write to, stdout by default')
+
+    def handle(self, *args, **options):
+        menus = self.get_menus(options)
+
+        if options['output']:
+            with open(options['output'], 'w') as fp:
+                export_menus(menus.iterator(), fp)
+        else:
+            export_menus(menus.iterator(), self.stdout)
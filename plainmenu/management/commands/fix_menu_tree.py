@@ -0,0 +1,63 @@
+from __future__ import unicode_literals
+
+import swapper
+
+from django.core.management.base import CommandError
+
+from plainmenu.management.base import MenusCommand
+
+
+class Command(MenusCommand):
+    help = 'Verifies and repairs item trees of menus, one menu at a time.'
+    action = 'repair'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--check', action='store_true', help='only report problems, fail if there are any')
+        parser.add_argument('--destructive', action='store_true', help='also re-parent orphans and renumber paths')
+        parser.add_argument('--links', action='store_true', help='also recompute normalized links of items')
+        parser.add_argument('--batch-size', type=int, default=100, help='menus fetched per query')
+
+    def handle(self, *args, **options):
+        MenuItem = swapper.load_model('plainmenu', 'MenuItem')
+
+        pks = self._batched(self.get_menus(options).values_list('pk', flat=True), options['batch_size'])
+
+        broken = 0
+        for menu_id in pks:
+            if options['links'] and not options['check']:
+                updated = MenuItem.refresh_normalized_links(menu_id)
+                if updated:
+                    self.stdout.write('Menu {}: {} links normalized'.format(menu_id, updated))
+
+            problems = MenuItem.find_tree_problems(menu_id)
+            count = sum(len(pks) for pks in problems.values())
+
+            if not count:
+                continue
+
+            broken += 1
+            summary = ', '.join('{} {}'.format(len(pks), name) for name, pks in problems.items() if pks)
+
+            if options['check']:
+                self.stdout.write('Menu {}: {}'.format(menu_id, summary))
+                continue
+
+            changed = MenuItem.repair_tree(menu_id, destructive=options['destructive'])
+            self.stdout.write('Menu {}: {}, {} items fixed'.format(menu_id, summary, len(changed)))
+
+        if options['check'] and broken:
+            raise CommandError('{} menus have problems'.format(broken))
+
+        self.stdout.write('{} menus {}'.format(broken, 'have problems' if options['check'] else 'repaired'))
+
+    @staticmethod
+    def _batched(pks, batch_size):
+        last = 0
+        while True:
+            batch = list(pks.filter(pk__gt=last)[:batch_size])
+            if not batch:
+                return
+            for pk in batch:
+                yield pk
+            last = batch[-1]
@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from plainmenu.transfer import import_menus, MenuImportError
+
+
+class Command(BaseCommand):
+    help = 'Imports menus exported by export_menus, existing menus get their items replaced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='file to read, - for stdin')
+        parser.add_argument('--group', help='import all menus into the group with this name')
+        parser.add_argument('--batch-size', type=int, default=500, help='items inserted per query')
+
+    def handle(self, *args, **options):
+        try:
+            if options['input'] == '-':
+                menus = import_menus(sys.stdin, options['group'], options['batch_size'])
+            else:
+                with open(options['input']) as fp:
+                    menus = import_menus(fp, options['group'], options['batch_size'])
+        except MenuImportError as e:
+            raise CommandError(e)
+
+        self.stdout.write('{} menus imported'.format(len(menus)))
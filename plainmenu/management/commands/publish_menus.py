@@ -0,0 +1,30 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import CommandError
+
+from plainmenu.conf import settings
+from plainmenu.management.base import MenusCommand
+from plainmenu.publish import publish_menus
+
+
+class Command(MenusCommand):
+    help = 'Renders menus to files under PLAINMENU_PUBLISH_DIR, shown by show_menu with published=True.'
+    action = 'publish'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--language', action='append', dest='languages',
+            help='language to render html for, may be repeated, LANGUAGE_CODE by default'
+        )
+
+    def handle(self, *args, **options):
+        if not settings.PUBLISH_DIR:
+            raise CommandError('PLAINMENU_PUBLISH_DIR is not set')
+
+        paths = publish_menus(self.get_menus(options).iterator(), options['languages'])
+
+        if options['verbosity'] > 1:
+            for path in paths:
+                self.stdout.write(path)
+        self.stdout.write('{} files published'.format(len(paths)))
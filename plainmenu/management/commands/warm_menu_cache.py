@@ -0,0 +1,25 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import CommandError
+
+from plainmenu.cache import get_cache
+from plainmenu.management.base import MenusCommand
+from plainmenu.warm import warm_menus
+
+
+class Command(MenusCommand):
+    help = 'Stores rendered html, layout and json of menus in PLAINMENU_CACHE ahead of requests.'
+    action = 'warm'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--language', action='append', dest='languages',
+            help='language to render html for, may be repeated, LANGUAGE_CODE by default'
+        )
+
+    def handle(self, *args, **options):
+        if get_cache() is None:
+            raise CommandError('PLAINMENU_CACHE is not set')
+
+        self.stdout.write('{} menus warmed'.format(warm_menus(self.get_menus(options).iterator(), options['languages'])))
@@ -1,41 +1,97 @@
 from __future__ import unicode_literals
 
-from functools import wraps
 from collections import OrderedDict
 
-from treebeard.mp_tree import MP_Node, get_result_class, MP_ComplexAddMoveHandler
+from treebeard.mp_tree import MP_Node, MP_NodeManager, MP_AddChildHandler, MP_AddSiblingHandler, get_result_class
+from treebeard.exceptions import InvalidMoveToDescendant, InvalidPosition, NodeAlreadySaved, PathOverflow
 
 import swapper
 
-from django.db import models, transaction
+from django.db import models, transaction, connections, router
+from django.db.models import Count, F, Q
+from django.db.models.functions import Length, Substr
+from django.utils.translation import ugettext_noop as _
 
+from .tree import build_tree, freeze, get_depth_limit, MenuSnapshot, TreeEditor
+from .cache import invalidate_menu_id
+from .conf import settings
+from .links import normalize_link, candidate_links
 
-def _monkeypatch_treebeard():
-    old_newpath = MP_ComplexAddMoveHandler.get_sql_newpath_in_branches
-    old_numchild = MP_ComplexAddMoveHandler.get_sql_update_numchild
 
-    @wraps(old_newpath)
-    def new_newpath(self, *args, **kwargs):
-        sql, vals = old_newpath(self, *args, **kwargs)
+class MenuScopedSQLMixin(object):
+    """
+    Limits raw sql of treebeard handlers to the menu of the node, paths are
+    only unique within a menu. Menu comes first to use (menu, path) index.
+    """
 
-        # only update sql for our model, ignore others (mp trees are also used by djangocms)
-        if self.node_cls == swapper.load_model('plainmenu', 'MenuItem'):
-            return sql + ' AND menu_id = %s', vals + [self.node.menu_id]
-        else:
-            return sql, vals
+    def _scope(self, sql, vals):
+        column = connections[router.db_for_write(self.node_cls)].ops.quote_name(
+            self.node_cls._meta.get_field('menu').column
+        )
+        return sql.replace('WHERE ', 'WHERE {} = %s AND '.format(column), 1), [self.node.menu_id] + vals
+
+    def get_sql_update_numchild(self, path, incdec='inc'):
+        sql, vals = super(MenuScopedSQLMixin, self).get_sql_update_numchild(path, incdec)
+        return self._scope(sql, vals)
+
+    def get_sql_newpath_in_branches(self, oldpath, newpath):
+        sql, vals = super(MenuScopedSQLMixin, self).get_sql_newpath_in_branches(oldpath, newpath)
+
+        # placeholders of SET go first
+        where = sql.index('WHERE ')
+        scoped, scoped_vals = self._scope(sql[where:], vals[-1:])
+        return sql[:where] + scoped, vals[:-1] + scoped_vals
 
-    @wraps(old_numchild)
-    def new_numchild(self, *args, **kwargs):
-        sql, vals = old_numchild(self, *args, **kwargs)
 
-        # only update sql for our model, ignore others (mp trees are also used by djangocms)
-        if self.node_cls == swapper.load_model('plainmenu', 'MenuItem'):
-            return sql + ' AND menu_id = %s', vals + [self.node.menu_id]
+class MenuItemAddSiblingHandler(MenuScopedSQLMixin, MP_AddSiblingHandler):
+    pass
+
+
+class MenuItemAddChildHandler(MP_AddChildHandler):
+    def process(self):
+        node = self.node
+
+        if node.node_order_by and not node.is_leaf():
+            # delegated to add_sibling
+            return super(MenuItemAddChildHandler, self).process()
+
+        if len(self.kwargs) == 1 and 'instance' in self.kwargs:
+            newobj = self.kwargs['instance']
+            if newobj.pk:
+                raise NodeAlreadySaved('Attempted to add a tree node that is already in the database')
+        else:
+            newobj = self.node_cls(**self.kwargs)
+
+        newobj.depth = node.depth + 1
+        if node.is_leaf():
+            newobj.path = self.node_cls._get_path(node.path, newobj.depth, 1)
+            if len(newobj.path) > self.node_cls._meta.get_field('path').max_length:
+                raise PathOverflow(_(
+                    'The new node is too deep in the tree, try increasing the path.max_length property'
+                    ' and UPDATE your database'
+                ))
         else:
-            return sql, vals
+            newobj.path = node.get_last_child()._inc_path()
 
-    MP_ComplexAddMoveHandler.get_sql_newpath_in_branches = new_newpath
-    MP_ComplexAddMoveHandler.get_sql_update_numchild = new_numchild
+        newobj.save()
+        newobj._cached_parent_obj = node
+
+        get_result_class(self.node_cls).objects.filter(
+            menu_id=node.menu_id, path=node.path
+        ).update(numchild=F('numchild') + 1)
+
+        node.numchild += 1
+        return newobj
+
+
+def _copy_instance(obj, **values):
+    """ Saves a copy of obj with concrete field values overridden by values """
+    fields = dict(
+        (field.attname, getattr(obj, field.attname)) for field in obj._meta.concrete_fields if not field.primary_key
+    )
+    fields.update(values)
+
+    return obj.__class__.objects.create(**fields)
 
 
 class AbstractGroup(models.Model):
@@ -50,6 +106,22 @@ class AbstractGroup(models.Model):
         return self.name
 
 
+    @transaction.atomic
+    def clone(self, name):
+        """
+        Copies the group with all its menus and their items, see
+        :meth:`AbstractMenu.clone`.
+
+        :returns: the new group
+        """
+        group = _copy_instance(self, name=name)
+
+        for menu in swapper.load_model('plainmenu', 'Menu').objects.filter(group=self).order_by('pk'):
+            menu.clone(group)
+
+        return group
+
+
 class Group(AbstractGroup):
     class Meta:
         swappable = swapper.swappable_setting('plainmenu', 'Group')
@@ -75,7 +147,98 @@ class AbstractMenu(models.Model):
 
 
     def get_items(self):
-        return self.menuitem_set.order_by(*MenuItem.node_order_by).filter(depth=1)
+        model = self.menuitem_set.model
+        return model.only_render_fields(self.menuitem_set.order_by(*model.node_order_by).filter(depth=1))
+
+
+    def get_tree(self, root=None, max_depth=None, levels=None):
+        """
+        :param root: pk or link of the item whose children are returned
+            instead of root items
+        :param max_depth: depth of the deepest loaded items
+        :param levels: number of loaded levels below root (or from the top)
+        :returns: root items of the menu with their descendants attached as
+            ``children`` lists, loaded with a single query (two with root).
+        """
+        items = self.menuitem_set.model.only_render_fields(self.menuitem_set.order_by('path'))
+        base_path, base_depth = '', 0
+
+        if root is not None:
+            if isinstance(root, int):
+                lookup = {'pk': root}
+            else:
+                lookup = {'normalized_link': normalize_link(root)}
+
+            node = None
+            if all(lookup.values()):
+                node = self.menuitem_set.filter(**lookup).order_by('path').values_list('path', 'depth').first()
+            if node is None:
+                return []
+
+            base_path, base_depth = node
+            items = items.filter(path__startswith=base_path, depth__gt=base_depth)
+
+        depth_limit = get_depth_limit(base_depth, max_depth, levels)
+        if depth_limit is not None:
+            items = items.filter(depth__lte=depth_limit)
+
+        return build_tree(items, base_path)
+
+
+    def aget_tree(self, **options):
+        """
+        Async counterpart of :meth:`get_tree`, see :mod:`plainmenu.aio`.
+
+        :returns: awaitable of the tree loaded in a worker thread
+        """
+        from .aio import sync_to_async
+
+        return sync_to_async(self.get_tree)(**options)
+
+
+    def compile(self):
+        """ :returns: :class:`MenuSnapshot` of the menu, rendered without database access """
+        group_name = self.group.name if self.group_id else None
+        return MenuSnapshot(self.identifier, group_name, freeze(self.get_tree()))
+
+
+    @transaction.atomic
+    def clone(self, to_group, identifier=None):
+        """
+        Copies the menu with its items to another group (None for no group).
+        Items keep their paths, they are copied with a single
+        ``INSERT ... SELECT`` regardless of the tree size.
+
+        :returns: the new menu
+        """
+        menu = _copy_instance(
+            self, group_id=to_group.pk if to_group is not None else None, identifier=identifier or self.identifier
+        )
+        swapper.load_model('plainmenu', 'MenuItem').copy_items(self.pk, menu.pk)
+
+        return menu
+
+
+    @classmethod
+    def get_trees(cls, menus):
+        """
+        :returns: dict of menu pk -> tree as returned by :meth:`get_tree`,
+            items of all menus are loaded with a single query.
+        """
+        trees = OrderedDict((menu.pk, []) for menu in menus)
+        if not trees:
+            return trees
+
+        model = swapper.load_model('plainmenu', 'MenuItem')
+        items = model.only_render_fields(model.objects.filter(menu__in=list(trees)).order_by('menu', 'path'))
+
+        for item in items:
+            trees[item.menu_id].append(item)
+
+        for pk, items in trees.items():
+            trees[pk] = build_tree(items)
+
+        return trees
 
 
 class Menu(AbstractMenu):
@@ -83,6 +246,68 @@ class Menu(AbstractMenu):
         swappable = swapper.swappable_setting('plainmenu', 'Menu')
 
 
+class MenuItemManager(MP_NodeManager):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.normalized_link = normalize_link(obj.link) or ''
+
+        return super(MenuItemManager, self).bulk_create(objs, *args, **kwargs)
+
+
+    def for_url(self, url, group=None):
+        """
+        Finds items linking to url or, when there are none, to its closest
+        parent url (site root is matched only exactly), looked up by
+        normalized link with one indexed query. Ancestors of all found
+        items are loaded with one more query.
+
+        :param group: group name or instance, items of all menus by default
+        :returns: list of items in menu and tree order, each with
+            ``ancestors`` list of its ancestors from the root
+        """
+        Group = swapper.load_model('plainmenu', 'Group')
+
+        candidates = candidate_links(url)
+        if not candidates:
+            return []
+
+        queryset = self.filter(normalized_link__in=candidates).select_related('menu').order_by('menu', 'path')
+        if isinstance(group, Group):
+            queryset = queryset.filter(menu__group=group)
+        elif group is not None:
+            queryset = queryset.filter(menu__group__name=group)
+
+        items = list(queryset)
+        if not items:
+            return []
+
+        best = min(candidates.index(item.normalized_link) for item in items)
+        items = [item for item in items if item.normalized_link == candidates[best]]
+
+        condition = Q()
+        for item in items:
+            paths = [item.path[:end] for end in range(item.steplen, len(item.path), item.steplen)]
+            if paths:
+                condition |= Q(menu_id=item.menu_id, path__in=paths)
+
+        ancestors = {}
+        if condition:
+            for ancestor in self.filter(condition).order_by():
+                ancestors[ancestor.menu_id, ancestor.path] = ancestor
+
+        for item in items:
+            item.ancestors = [
+                ancestors[item.menu_id, item.path[:end]]
+                for end in range(item.steplen, len(item.path), item.steplen)
+                if (item.menu_id, item.path[:end]) in ancestors
+            ]
+            if item.ancestors:
+                item._cached_parent_obj = item.ancestors[-1]
+
+        return items
+
+
 class AbstractMenuItem(MP_Node):
     node_order_by = ['sort_weight']
     TARGET_NONE = 1
@@ -98,28 +323,226 @@ class AbstractMenuItem(MP_Node):
     link = models.CharField(max_length=256, blank=True)
     menu = models.ForeignKey(swapper.get_model_name('plainmenu', 'Menu'), on_delete=models.CASCADE)
     target = models.PositiveSmallIntegerField(choices=TARGET_CHOICES.items(), default=TARGET_NONE)
+    # link reduced by normalize_link for lookups by url, kept up to date on save and bulk_create
+    normalized_link = models.CharField(max_length=256, blank=True, editable=False)
+
+    objects = MenuItemManager()
+
+    #: fields loaded for rendering besides node_order_by and ``PLAINMENU_RENDER_EXTRA_FIELDS``
+    render_fields = ('path', 'depth', 'numchild', 'title', 'hint', 'link', 'target', 'menu')
 
     class Meta:
         abstract = True
         unique_together = (
             ('path', 'menu'),
         )
+        # every tree query is scoped by menu, get_items() filters roots by depth
+        indexes = [
+            models.Index(fields=['menu', 'depth', 'sort_weight']),
+            models.Index(fields=['menu', 'path']),
+            models.Index(fields=['normalized_link']),
+        ]
 
 
     def __str__(self):
         return self.title
 
 
+    def save(self, *args, **kwargs):
+        self.normalized_link = normalize_link(self.link) or ''
+        return super(AbstractMenuItem, self).save(*args, **kwargs)
+
+
+    @classmethod
+    def refresh_normalized_links(cls, menu_id):
+        """
+        Recomputes normalized links of the menu's items, e.g. after links
+        were changed with ``update()``.
+
+        :returns: number of updated items
+        """
+        model = get_result_class(cls)
+        changed = []
+
+        for pk, link, normalized_link in model.objects.filter(menu_id=menu_id).values_list('pk', 'link', 'normalized_link'):
+            if (normalize_link(link) or '') != normalized_link:
+                changed.append(model(pk=pk, normalized_link=normalize_link(link) or ''))
+
+        model.objects.bulk_update(changed, ['normalized_link'], batch_size=500)
+
+        return len(changed)
+
+
     def fix_tree(self, destructive=False):
-        for i, item in enumerate(self.get_children()):
-            item.sort_order = i
-            item.save()
+        """
+        Repairs depth and numchild of the item's subtree, other items and
+        menus are not touched. See :meth:`repair_tree`.
+        """
+        return self.repair_tree(self.menu_id, self.path, destructive)
+
+
+    @classmethod
+    def repair_tree(cls, menu_id, path='', destructive=False):
+        """
+        Repairs depth and numchild of items of the menu under path (the
+        whole menu by default) loaded with a single query, changes are
+        written in bulk. Destructive repair also re-parents orphans and
+        renumbers paths by sort weight.
+
+        :returns: list of changed items
+        """
+        model = get_result_class(cls)
+
+        with transaction.atomic():
+            editor = TreeEditor.load(model, menu_id, [path])
+            editor.repair(editor.by_path.get(path), destructive)
+            changed = editor.save()
 
-        super(AbstractMenuItem, self).fix_tree(destructive)
-        
-        for item in self.get_children():
-            item.numchild = item.get_children().count()
-            item.save()
+        if changed:
+            invalidate_menu_id(menu_id)
+
+        return changed
+
+
+    @classmethod
+    def reorder(cls, menu_id, moves):
+        """
+        Applies many moves within the menu in one transaction, the menu is
+        loaded with a single query and changes are written in bulk. See
+        :meth:`TreeEditor.rearrange`.
+
+        :param moves: list of (item pk, parent pk or None for root, index
+            among new siblings or None for last)
+        :returns: list of changed items
+        """
+        model = get_result_class(cls)
+
+        with transaction.atomic():
+            editor = TreeEditor.load(model, menu_id, [''])
+            resolved = []
+
+            if len(set(pk for pk, parent, index in moves)) != len(moves):
+                raise InvalidPosition('Every item can be moved only once')
+
+            for pk, parent, index in moves:
+                if index is not None and (not isinstance(index, int) or index < 0):
+                    raise InvalidPosition('Invalid position {!r} of item {}'.format(index, pk))
+
+                for item_pk in (pk, parent):
+                    if item_pk is not None and item_pk not in editor.by_pk:
+                        raise model.DoesNotExist('Item {} not found in menu {}'.format(item_pk, menu_id))
+
+                resolved.append((editor.by_pk[pk], editor.by_pk.get(parent), index))
+
+            editor.rearrange(resolved)
+            changed = editor.save()
+
+        if changed:
+            invalidate_menu_id(menu_id)
+
+        return changed
+
+
+    @classmethod
+    def copy_items(cls, from_menu_id, to_menu_id):
+        """
+        Copies all items of a menu to another one with a single query,
+        paths are reused as they are scoped by menu.
+
+        :returns: number of copied items
+        """
+        model = get_result_class(cls)
+        connection = connections[router.db_for_write(model)]
+        qn = connection.ops.quote_name
+
+        menu_column = model._meta.get_field('menu').column
+        columns = [field.column for field in model._meta.concrete_fields if not field.primary_key]
+        table = qn(model._meta.db_table)
+
+        with connection.cursor() as cursor:
+            cursor.execute('INSERT INTO {} ({}) SELECT {} FROM {} WHERE {} = %s'.format(
+                table,
+                ', '.join(qn(column) for column in columns),
+                ', '.join('%s' if column == menu_column else qn(column) for column in columns),
+                table,
+                qn(menu_column),
+            ), [to_menu_id, from_menu_id])
+            return cursor.rowcount
+
+
+    @classmethod
+    def find_tree_problems(cls, menu_id):
+        """
+        Checks tree of the menu, numchild is verified with one aggregated
+        query instead of loading items.
+
+        :returns: dict of problem name -> list of item pks, same problems
+            as treebeard's ``find_problems`` reports for the whole table
+        """
+        model = get_result_class(cls)
+        items = model.objects.filter(menu_id=menu_id)
+
+        counts = dict(
+            items.order_by().annotate(
+                parent_path=Substr('path', 1, Length('path') - cls.steplen)
+            ).values('parent_path').annotate(count=Count('pk')).values_list('parent_path', 'count')
+        )
+
+        alphabet = set(cls.alphabet)
+        problems = OrderedDict((name, []) for name in (
+            'evil_chars', 'bad_steplen', 'orphans', 'wrong_depth', 'wrong_numchild'
+        ))
+        rows = list(items.order_by('path').values_list('pk', 'path', 'depth', 'numchild'))
+        paths = set(row[1] for row in rows)
+
+        for pk, path, depth, numchild in rows:
+            if set(path) - alphabet:
+                problems['evil_chars'].append(pk)
+            if len(path) % cls.steplen:
+                problems['bad_steplen'].append(pk)
+            if len(path) > cls.steplen and path[:-cls.steplen] not in paths:
+                problems['orphans'].append(pk)
+            if depth != len(path) // cls.steplen:
+                problems['wrong_depth'].append(pk)
+            if numchild != counts.get(path, 0):
+                problems['wrong_numchild'].append(pk)
+
+        return problems
+
+
+    @classmethod
+    def get_render_fields(cls):
+        """ :returns: names of fields loaded for rendering or None for all fields """
+        extra = settings.RENDER_EXTRA_FIELDS
+        if extra == '__all__':
+            return None
+
+        return tuple(OrderedDict.fromkeys(tuple(cls.render_fields) + tuple(cls.node_order_by) + tuple(extra)))
+
+
+    @classmethod
+    def only_render_fields(cls, queryset):
+        """ Limits queryset of items to :meth:`get_render_fields`, others are loaded on access """
+        fields = cls.get_render_fields()
+        return queryset.only(*fields) if fields is not None else queryset
+
+
+    @property
+    def children(self):
+        """
+        List of child items, attached by :func:`~plainmenu.tree.build_tree`
+        to items of ``get_tree()``. Items got otherwise (e.g. from
+        ``Menu.get_items()``) load their children on first access.
+        """
+        if '_children' not in self.__dict__:
+            self._children = list(self.only_render_fields(self.get_children()))
+
+        return self._children
+
+
+    @children.setter
+    def children(self, value):
+        self._children = value
 
 
     def target_html(self):
@@ -129,40 +552,61 @@ class AbstractMenuItem(MP_Node):
             return 'target="_blank"'
 
 
+    def add_child(self, **kwargs):
+        """ Same as treebeard's one, with sql limited to the menu of the item """
+        return MenuItemAddChildHandler(self, **kwargs).process()
+
+
+    def add_sibling(self, pos=None, **kwargs):
+        """ Same as treebeard's one, with sql limited to the menu of the item """
+        return MenuItemAddSiblingHandler(self, pos, **kwargs).process()
+
+
     @transaction.atomic
     def move(self, target, pos=None):
-        original_parent = self.get_parent()
+        """
+        Moves item before target (sibling positions) or makes it the last
+        child of target (child positions).
+
+        Sort weights, paths, depth and numchild of both affected levels are
+        recomputed in memory and written with a bounded number of queries.
+        """
+        pos = self._prepare_pos_var_for_move(pos)
 
-        if self.menu != target.menu:
-            target = self
+        if self.menu_id != target.menu_id or self.pk == target.pk:
+            return
 
-        if self == target:
-            pass
-        elif 'sibling' in pos:
-            target_siblings = list(target.get_siblings())
+        as_child = pos.endswith('-child')
+        new_parent_path = target.path if as_child else target.path[:-self.steplen]
 
-            if self in target_siblings:
-                target_siblings.remove(self)
+        if new_parent_path.startswith(self.path):
+            raise InvalidMoveToDescendant(_("Can't move node to a descendant."))
 
-            target_siblings.insert(target_siblings.index(target), self)
+        editor = TreeEditor.load(get_result_class(self.__class__), self.menu_id, [self.path[:-self.steplen], new_parent_path])
+        node = editor.by_pk[self.pk]
+        new_parent = editor.by_path.get(new_parent_path)
 
-            for i, item in enumerate(target_siblings):
-                item.sort_weight = i
-                item.save()
+        siblings = [item for item in editor.get_children(new_parent) if item.pk != self.pk]
 
+        if as_child:
+            node.sort_weight = siblings[-1].sort_weight + 1 if siblings else 0
+            editor.move(node, new_parent)
         else:
-            last_child = target.get_last_child()
-            self.sort_weight = last_child.sort_weight + 1 if last_child else 0
-            self.save()
-            
-        if original_parent:
-            original_parent.fix_tree()
-            target.refresh_from_db()
+            editor.move(node, new_parent, [item.pk for item in siblings].index(target.pk))
 
-        super(AbstractMenuItem, self).move(target, pos)
+            for i, item in enumerate(editor.get_children(new_parent)):
+                item.sort_weight = i
 
-        if original_parent:
-            original_parent.fix_tree()
+        editor.save()
+
+        for obj in (self, target):
+            loaded = editor.by_pk.get(obj.pk)
+            if loaded is not None:
+                for field in editor.FIELDS:
+                    setattr(obj, field, getattr(loaded, field))
+            obj.__dict__.pop('_cached_parent_obj', None)
+
+        invalidate_menu_id(self.menu_id)
 
 
     def get_sorted_pos_queryset(self, siblings, newobj):
@@ -210,8 +654,6 @@ AbstractMenuItem._meta.get_field('path')._unique = False
 
 
 class MenuItem(AbstractMenuItem):
-    class Meta:
+    class Meta(AbstractMenuItem.Meta):
         swappable = swapper.swappable_setting('plainmenu', 'MenuItem')
 
-
-_monkeypatch_treebeard()
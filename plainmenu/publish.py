@@ -0,0 +1,206 @@
+"""
+Menus pre-rendered to files under ``PLAINMENU_PUBLISH_DIR``, shown by
+``{% show_menu 'top' 'main' published=True %}`` without database or cache
+access. Every menu is written as ``<identifier>.<language>.html`` rendered
+with ``plainmenu/menu.html`` and ``<identifier>.json`` with its tree,
+menus of a group are kept in ``group-<name>`` directory.
+
+Files are replaced atomically, so readers never see partial content.
+"""
+from __future__ import unicode_literals
+
+import io
+import os
+import tempfile
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+import swapper
+
+from django.conf import settings as django_settings
+from django.db import transaction
+from django.template import loader
+from django.utils import translation
+
+from .cache import get_group_name
+from .conf import settings
+from .renderer import DEFAULT_TEMPLATE
+from .tree import tree_json
+
+
+def _menu_dir(group_name):
+    return os.path.join(
+        settings.PUBLISH_DIR, 'group-' + quote(group_name, safe='') if group_name is not None else 'nogroup'
+    )
+
+
+def get_published_path(identifier, group_name, language=None, ext='html'):
+    """ :returns: path of the published file, html ones are per language """
+    name = quote(identifier, safe='')
+    if ext == 'html':
+        name += '.' + (language or _current_language())
+
+    return os.path.join(_menu_dir(group_name), name + '.' + ext)
+
+
+def _current_language():
+    return translation.get_language() or django_settings.LANGUAGE_CODE
+
+
+def _write(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with io.open(fd, 'w', encoding='utf-8') as fp:
+            fp.write(content)
+        os.chmod(tmp_path, 0o644)
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def get_published_languages(identifier, group_name):
+    """ :returns: sorted language codes the menu has published html for """
+    directory = _menu_dir(group_name)
+    prefix = quote(identifier, safe='') + '.'
+    languages = []
+
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            rest = name[len(prefix):] if name.startswith(prefix) else None
+            if rest and rest.endswith('.html') and '.' not in rest[:-len('.html')]:
+                languages.append(rest[:-len('.html')])
+
+    return sorted(languages)
+
+
+def publish_menu(menu, languages=None):
+    """
+    Renders the menu to files, its tree is loaded with a single query.
+
+    :param languages: language codes to render html for, by default the
+        ones already published for the menu or the current one
+    :returns: list of written paths
+    """
+    group_name = get_group_name(menu)
+    items = menu.get_tree()
+    paths = []
+
+    languages = languages or get_published_languages(menu.identifier, group_name) or [_current_language()]
+    for language in languages:
+        with translation.override(language):
+            html = loader.render_to_string(DEFAULT_TEMPLATE, {
+                'items': items, 'active_path': None, 'active_paths': (),
+            })
+
+        path = get_published_path(menu.identifier, group_name, language)
+        _write(path, html)
+        paths.append(path)
+
+    path = get_published_path(menu.identifier, group_name, ext='json')
+    _write(path, tree_json(items))
+    paths.append(path)
+
+    return paths
+
+
+def publish_menus(menus, languages=None):
+    """ :returns: list of written paths """
+    paths = []
+    for menu in menus:
+        paths.extend(publish_menu(menu, languages))
+
+    return paths
+
+
+def unpublish_menu(identifier, group_name):
+    """ Removes published files of the menu """
+    paths = [
+        get_published_path(identifier, group_name, language)
+        for language in get_published_languages(identifier, group_name)
+    ]
+    paths.append(get_published_path(identifier, group_name, ext='json'))
+
+    for path in paths:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _on_save_enabled():
+    return settings.PUBLISH_ON_SAVE and settings.PUBLISH_DIR
+
+
+def publish_on_commit(menu_id, previous=None):
+    """
+    Publishes the menu once the transaction commits, in every language
+    it is published in, if ``PLAINMENU_PUBLISH_ON_SAVE`` is set.
+
+    :param previous: (identifier, group name) the menu had before the
+        change, its files are moved to the current ones
+    """
+    if not _on_save_enabled():
+        return
+
+    def publish():
+        Menu = swapper.load_model('plainmenu', 'Menu')
+        menu = Menu.objects.select_related('group').filter(pk=menu_id).first()
+        languages = set()
+
+        if previous is not None and (menu is None or previous != (menu.identifier, get_group_name(menu))):
+            languages.update(get_published_languages(*previous))
+            unpublish_menu(*previous)
+
+        if menu is not None:
+            languages.update(get_published_languages(menu.identifier, get_group_name(menu)))
+            publish_menu(menu, sorted(languages))
+
+    transaction.on_commit(publish)
+
+
+def unpublish_on_commit(identifier, group_name):
+    """ Removes files of the deleted menu once the transaction commits, if ``PLAINMENU_PUBLISH_ON_SAVE`` is set """
+    if _on_save_enabled():
+        transaction.on_commit(lambda: unpublish_menu(identifier, group_name))
+
+
+# path -> (mtime, size, content) of files read by this process
+_files = {}
+
+
+def read_published(identifier, group_name, language=None):
+    """
+    Reads published html of the menu, content is kept in process memory
+    and read again only when the file's mtime or size changes.
+
+    :returns: html or None if the menu isn't published
+    """
+    if not settings.PUBLISH_DIR:
+        return None
+
+    path = get_published_path(identifier, group_name, language)
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        _files.pop(path, None)
+        return None
+
+    cached = _files.get(path)
+    if cached is not None and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+
+    try:
+        with io.open(path, encoding='utf-8') as fp:
+            content = fp.read()
+    except (IOError, OSError):
+        return None
+
+    _files[path] = (stat.st_mtime, stat.st_size, content)
+    return content
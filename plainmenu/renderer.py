@@ -0,0 +1,78 @@
+from __future__ import unicode_literals
+
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+
+DEFAULT_TEMPLATE = 'plainmenu/menu.html'
+ITEM_TEMPLATE = 'plainmenu/menu_item.html'
+BREADCRUMBS_TEMPLATE = 'plainmenu/breadcrumbs.html'
+
+
+def render_menu(items, submenu=False, active_path=None, active_paths=()):
+    """
+    Renders items the same way as ``plainmenu/menu.html`` does, byte for
+    byte, without going through the template engine.
+
+    Works with trees of menu items from ``get_tree()`` and with frozen
+    :class:`~plainmenu.tree.MenuNode` trees.
+    """
+    parts = []
+    _render_items(items, submenu, active_path, active_paths, parts.append)
+    return mark_safe(''.join(parts))
+
+
+def render_item(item, active_path=None, active_paths=()):
+    """ Renders item with its subtree the same way as ``plainmenu/menu_item.html`` """
+    parts = []
+    _render_item(item, active_path, active_paths, parts.append)
+    return mark_safe(''.join(parts))
+
+
+def wrap_items(fragments, submenu=False):
+    """ Joins rendered items into a list the same way as ``plainmenu/menu.html`` """
+    return mark_safe(
+        ('<ul class="menu submenu">\n' if submenu else '<ul class="menu">\n') + ''.join(fragments) + '\n</ul>\n'
+    )
+
+
+def _render_items(items, submenu, active_path, active_paths, write):
+    write('<ul class="menu submenu">\n' if submenu else '<ul class="menu">\n')
+
+    for item in items:
+        _render_item(item, active_path, active_paths, write)
+
+    write('\n</ul>\n')
+
+
+def _render_item(item, active_path, active_paths, write):
+    if item.path == active_path:
+        write('\n<li class="active">\n')
+    elif item.path in active_paths:
+        write('\n<li class="expanded">\n')
+    else:
+        write('\n<li>\n')
+
+    if item.link:
+        target_html = item.target_html
+        if callable(target_html):
+            target_html = target_html()
+
+        write('<a href="')
+        write(conditional_escape(item.link))
+        write('" ')
+        write(conditional_escape(target_html))
+        write('>')
+        write(conditional_escape(item.title))
+        write('</a>')
+    else:
+        write(conditional_escape(item.title))
+
+    write('\n')
+
+    if item.children:
+        write('\n    ')
+        _render_items(item.children, True, active_path, active_paths, write)
+        write('\n')
+
+    write('\n')
@@ -0,0 +1,15 @@
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+
+#: Sent after ``show_menu`` with ``identifier``, ``group_name`` and ``stats``
+#: dict of ``queries``, ``db_time``, ``time``, ``render_time``, ``cache``
+#: (``'hit'``, ``'miss'``, ``'lru'``, ``'fragments'``, ``'stale'``, ``'published'``
+#: or None when not cached) and ``nodes``
+#: (None when the tree wasn't loaded).
+menu_rendered = Signal()
+
+#: Sent after menu admin views with ``view`` name, ``object_id`` and
+#: ``stats`` dict of ``queries``, ``db_time`` and ``time``.
+admin_view_rendered = Signal()
@@ -0,0 +1,63 @@
+(function ($) {
+    // Rows of collapsed levels are not rendered upfront, they are fetched
+    // from PLAINMENU_CHILDREN_ENDPOINT when their parent is expanded.
+
+    function children(nodeId) {
+        return $('#result_list tr[parent=' + nodeId + ']');
+    }
+
+    function collapse(nodeId) {
+        children(nodeId).each(function () {
+            collapse($(this).attr('node'));
+        }).hide();
+        $('#node-' + nodeId + '-id a.collapse').removeClass('expanded').addClass('collapsed');
+    }
+
+    function expand(nodeId) {
+        children(nodeId).show();
+        $('#node-' + nodeId + '-id a.collapse').removeClass('collapsed').addClass('expanded');
+    }
+
+    function enableDrag($rows) {
+        // treebeard binds drag handlers once on page load, reuse its handler for fetched rows
+        var $bound = $('td.drag-handler span.active').first();
+        var events = $bound.length ? $._data($bound[0], 'events') : null;
+
+        if (events && events.mousedown) {
+            $rows.find('td.drag-handler span').addClass('active').bind('mousedown', events.mousedown[0].handler);
+        }
+    }
+
+    function load($row) {
+        var nodeId = $row.attr('node');
+
+        $.get(window.PLAINMENU_CHILDREN_ENDPOINT, {node: nodeId}, function (html) {
+            var $rows = $($.parseHTML($.trim(html))).filter('tr');
+
+            $row.after($rows).attr('loaded', '1');
+            enableDrag($rows);
+            init($rows);
+            expand(nodeId);
+        });
+    }
+
+    function init($rows) {
+        $rows.find('a.collapse').unbind('click').click(function () {
+            var $row = $(this).closest('tr');
+
+            if ($row.attr('loaded') === '0') {
+                load($row);
+            } else if ($(this).hasClass('collapsed')) {
+                expand($row.attr('node'));
+            } else {
+                collapse($row.attr('node'));
+            }
+            return false;
+        });
+        $rows.filter('[loaded=0]').find('a.collapse').removeClass('expanded').addClass('collapsed');
+    }
+
+    $(document).ready(function () {
+        init($('#result_list tbody tr'));
+    });
+})(django.jQuery);
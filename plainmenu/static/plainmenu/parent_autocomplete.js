@@ -0,0 +1,33 @@
+(function ($) {
+    // Searches menu items by title and stores pk of the picked one in the hidden input.
+
+    $(document).ready(function () {
+        $('.plainmenu-autocomplete').each(function () {
+            var $widget = $(this);
+            var $value = $widget.find('input[type=hidden]');
+            var $search = $widget.find('.plainmenu-autocomplete-search');
+            var $results = $widget.find('.plainmenu-autocomplete-results');
+            var request = null;
+
+            $search.bind('input', function () {
+                if (request) {
+                    request.abort();
+                }
+
+                request = $.getJSON($widget.data('url'), {term: $search.val(), exclude: $value.data('exclude')}, function (data) {
+                    $results.empty();
+                    $.each(data.results, function (i, result) {
+                        $('<li>').text(result.text).data('id', result.id).appendTo($results);
+                    });
+                    $results.toggle(data.results.length > 0);
+                });
+            });
+
+            $results.delegate('li', 'click', function () {
+                $value.val($(this).data('id'));
+                $search.val($.trim($(this).text()));
+                $results.hide();
+            });
+        });
+    });
+})(django.jQuery);
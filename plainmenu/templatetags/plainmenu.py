@@ -1,45 +1,447 @@
 from __future__ import absolute_import
+import os
+
 from django import template
+from django.utils import translation
+from django.utils.safestring import mark_safe
 import swapper
 
+from plainmenu import cache as menu_cache, publish, utils
+from plainmenu.conf import settings
+from plainmenu.links import link_index, find_active, get_active_paths
+from plainmenu.renderer import render_menu, render_item, wrap_items, DEFAULT_TEMPLATE, ITEM_TEMPLATE, BREADCRUMBS_TEMPLATE
+from plainmenu.instrumentation import measure, measure_render
+from plainmenu.signals import menu_rendered
+from plainmenu.tree import freeze, select_subtree, tree_size, count_nodes, MenuSnapshot
+
 register = template.Library()
 
-@register.simple_tag(takes_context=True)
-def show_menu(context, menu_name, group_name=None, **kwargs):
+
+PARTIAL_OPTIONS = ('root', 'max_depth', 'levels')
+
+
+def _get_tree(request, menu_name, group_name, key, partial=None):
+    """ :param partial: dict of :meth:`~plainmenu.models.AbstractMenu.get_tree` options """
+    tree = utils.get_prefetched_tree(request, key) if request is not None else None
+    if tree is not None:
+        return select_subtree(tree, **partial) if partial else tree
+
+    menu = utils.get_menu(menu_name, group_name)
+    return menu.get_tree(**(partial or {})) if menu else []
+
+
+def _get_partial(kwargs):
+    return dict((name, kwargs[name]) for name in PARTIAL_OPTIONS if kwargs.get(name) is not None)
+
+
+def _get_variant(partial, template_name, renderer):
+    flavor = 'fast' if template_name is None and (renderer or settings.RENDERER) == 'fast' else None
+    return menu_cache.rendered_variant(flavor, [(name, partial[name]) for name in PARTIAL_OPTIONS if name in partial])
+
+
+def _get_cache_key(menu_name, group_name):
     Menu = swapper.load_model('plainmenu', 'Menu')
     Group = swapper.load_model('plainmenu', 'Group')
 
-    template_name = kwargs.get('template', 'plainmenu/menu.html')
-
-    if isinstance(group_name, Group):
-        group = group_name
-    elif group_name is not None:
-        try:
-            group = Group.objects.get(name=group_name)
-        except Group.DoesNotExist:
-            group = None
+    if isinstance(menu_name, Menu):
+        return menu_name.identifier, menu_cache.get_group_name(menu_name)
+    elif isinstance(group_name, Group):
+        return menu_name, group_name.name
     else:
-        group = None
+        return menu_name, group_name
 
-    if isinstance(menu_name, Menu):
-        menu = menu_name
+
+def _get_steplen():
+    return swapper.load_model('plainmenu', 'MenuItem').steplen
+
+
+_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+
+
+def _uses_default_templates():
+    """
+    :returns: whether menu templates are the ones shipped with plainmenu,
+        overrides of ``plainmenu/menu.html`` can't be split into fragments
+    """
+    for name in (DEFAULT_TEMPLATE, ITEM_TEMPLATE):
+        origin = template.loader.get_template(name).origin.name
+        if os.path.dirname(os.path.abspath(origin)) != os.path.join(_TEMPLATE_DIR, 'plainmenu'):
+            return False
+
+    return True
+
+
+def _find_active(items, url):
+    return find_active(link_index(items), url) if url is not None else None
+
+
+def _render(context, template_name, items, renderer, stats, active_path=None):
+    context['items'] = items
+    context['active_path'] = active_path
+    context['active_paths'] = active_paths = get_active_paths(active_path, _get_steplen())
+
+    with measure_render(stats):
+        if template_name is None:
+            if (renderer or settings.RENDERER) == 'fast':
+                return render_menu(items, active_path=active_path, active_paths=active_paths)
+            template_name = DEFAULT_TEMPLATE
+
+        return template.loader.render_to_string(
+            template_name, context.flatten(), request=context['request']
+        )
+
+
+def _render_fragment(context, item, flavor, active_path):
+    active_paths = get_active_paths(active_path, _get_steplen())
+
+    if flavor == 'fast':
+        return render_item(item, active_path, active_paths)
+
+    values = context.flatten()
+    values.update(item=item, active_path=active_path, active_paths=active_paths)
+    return template.loader.render_to_string(ITEM_TEMPLATE, values, request=context['request'])
+
+
+@register.simple_tag(takes_context=True)
+def show_menu(context, menu_name, group_name=None, **kwargs):
+    """
+    Renders menu found by identifier (or passed as instance) within group.
+    Compiled :class:`~plainmenu.tree.MenuSnapshot` is rendered as is.
+
+    With ``PLAINMENU_CACHE`` set rendered html is cached until the menu
+    changes, pass ``cache=False`` for templates depending on the context.
+    With ``PLAINMENU_LRU_SIZE`` set too, trees of menus shown without
+    ``template=`` are kept in process memory instead and rendered on every
+    call, custom templates get model instances and their html is cached.
+
+    Default markup is rendered without the template engine with
+    ``renderer='fast'`` or ``PLAINMENU_RENDERER = 'fast'``, overrides of
+    ``plainmenu/menu.html`` are ignored then, ``template=`` is not.
+
+    With ``active=True`` the item linking to the current page (or its
+    closest parent url) gets ``active`` class and its ancestors get
+    ``expanded``, another url can be passed instead of True. Root items
+    of the default markup are cached separately then, only the one
+    containing the active item is rendered on every call. When
+    ``plainmenu/menu.html`` or ``plainmenu/menu_item.html`` is overridden,
+    the whole menu is rendered with the override on every call instead.
+
+    Part of the menu is shown with ``root=`` (pk or link of the item whose
+    children are shown), ``max_depth=`` (depth of the deepest shown items)
+    and ``levels=`` (number of shown levels below root), only that part is
+    loaded from the database. Parts are cached apart from the whole menu.
+
+    With ``published=True`` html written by ``publish_menus`` command is
+    shown as is, see :mod:`plainmenu.publish`, menus not published yet
+    are rendered as usual. Context, ``template=`` and ``renderer=`` are
+    not applied to published html.
+
+    Every call is reported with :data:`~plainmenu.signals.menu_rendered`.
+    """
+    if isinstance(menu_name, MenuSnapshot):
+        info = {'identifier': menu_name.identifier, 'group_name': menu_name.group_name}
     else:
-        try:
-            menu = Menu.objects.get(identifier=menu_name, group=group)
-        except Menu.DoesNotExist:
-            menu = None
+        info = {'identifier': getattr(menu_name, 'identifier', menu_name), 'group_name': getattr(group_name, 'name', group_name)}
+
+    with measure(menu_rendered, **info) as stats:
+        return _show_menu(context, menu_name, group_name, kwargs, stats)
+
+
+def _show_menu(context, menu_name, group_name, kwargs, stats):
+    template_name = kwargs.get('template')
+    renderer = kwargs.get('renderer')
+    partial = _get_partial(kwargs)
+    stats['cache'] = None
+
+    request = context.get('request')
+    url = kwargs.get('active')
+    if url is True:
+        url = request.path if request is not None else None
+    elif not url:
+        url = None
+
+    if isinstance(menu_name, MenuSnapshot):
+        items = select_subtree(menu_name.items, **partial) if partial else menu_name.items
+        stats['nodes'] = count_nodes(items)
+        return _render(context, template_name, items, renderer, stats, _find_active(items, url))
+
+    use_cache = kwargs.get('cache', True) and menu_cache.get_cache() is not None
+    key = _get_cache_key(menu_name, group_name)
+
+    if kwargs.get('published') and url is None and not partial:
+        html = publish.read_published(key[0], key[1])
+        if html is not None:
+            stats['cache'] = 'published'
+            stats['nodes'] = None
+            return mark_safe(html)
+
+    if url is not None:
+        # fragments are cached for the whole menu with shipped templates only
+        fast = (renderer or settings.RENDERER) == 'fast'
+        if not use_cache or template_name is not None or partial or not (fast or _uses_default_templates()):
+            items = _get_tree(request, menu_name, group_name, key, partial)
+            stats['nodes'] = count_nodes(items)
+            return _render(context, template_name, items, renderer, stats, _find_active(items, url))
+
+        return _show_active_menu(context, menu_name, group_name, key, renderer, url, stats)
+
+    # custom templates may read anything of model instances, frozen nodes are kept for default markup only
+    tree_cache = menu_cache.get_tree_cache() if use_cache and template_name is None else None
+    if tree_cache is not None:
+        keys = [key] + utils.get_pending_keys(request) if request is not None else [key]
+        version = menu_cache.get_versions(keys, request)[key]
+        items = tree_cache.get(key, version)
+        stats['cache'] = 'lru' if items is not None else 'miss'
+
+        if items is None:
+            items = freeze(_get_tree(request, menu_name, group_name, key))
+            tree_cache.set(key, version, items, tree_size(items))
+
+        # whole trees are kept in memory, parts are cut out of them
+        if partial:
+            items = select_subtree(items, **partial)
+
+        stats['nodes'] = count_nodes(items)
+        return _render(context, template_name, items, renderer, stats)
 
-    context['items'] = menu.get_items() if menu else []
+    version = lock = None
+    variant = _get_variant(partial, template_name, renderer)
+    if use_cache:
+        html, version, stale = menu_cache.get_rendered(key[0], key[1], template_name, variant, stale=True)
+        stats['cache'] = 'hit' if html is not None else 'miss'
+        if html is not None:
+            stats['nodes'] = None
+            return html
 
+        # only one worker rebuilds the menu, others serve its previous version or wait
+        lock = menu_cache.acquire_rebuild(key + (template_name, variant), version)
+        if lock is None:
+            html = stale if stale is not None else menu_cache.wait_rendered(key[0], key[1], template_name, variant)
+            if html is not None:
+                stats['cache'] = 'stale' if stale is not None else 'hit'
+                stats['nodes'] = None
+                return html
+
+    try:
+        items = _get_tree(request, menu_name, group_name, key, partial)
+        stats['nodes'] = count_nodes(items)
+        html = _render(context, template_name, items, renderer, stats)
+
+        if use_cache:
+            menu_cache.set_rendered(key[0], key[1], template_name, version, html, variant)
+    finally:
+        menu_cache.release_rebuild(lock)
+
+    return html
+
+
+def _show_active_menu(context, menu_name, group_name, key, renderer, url, stats):
+    """
+    Renders default markup out of root items cached separately, with the
+    link index and root paths of the menu cached as its layout.
+    """
+    flavor = 'fast' if (renderer or settings.RENDERER) == 'fast' else 'template'
+    language = translation.get_language() or ''
+
+    def fragment_name(path):
+        return ('fragment', flavor, language, path)
+
+    found, version = menu_cache.get_data(key[0], key[1], [menu_cache.LAYOUT])
+    layout = found.get(menu_cache.LAYOUT)
+
+    if layout is not None:
+        index, roots = layout
+        active_path = find_active(index, url)
+        active_root = active_path[:_get_steplen()] if active_path is not None else None
+
+        names = [fragment_name(path) for path in roots if path != active_root]
+        if active_root is not None:
+            names.append(('subtree', active_root))
+
+        found, version = menu_cache.get_data(key[0], key[1], names, version)
+
+        # roots not rendered yet are rendered from their cached subtrees
+        missing = [path for path in roots if path != active_root and fragment_name(path) not in found]
+        if missing:
+            subtrees, version = menu_cache.get_data(key[0], key[1], [('subtree', path) for path in missing], version)
+            found.update(subtrees)
+
+        if all(('subtree', path) in found for path in missing + [active_root] if path is not None):
+            stats['cache'] = 'fragments'
+            stats['nodes'] = None
+            fragments = []
+            fresh = {}
+
+            with measure_render(stats):
+                for path in roots:
+                    if path == active_root or path in missing:
+                        html = _render_fragment(context, found[('subtree', path)], flavor, active_path)
+                        if path != active_root:
+                            fresh[fragment_name(path)] = html
+                    else:
+                        html = found[fragment_name(path)]
+                    fragments.append(html)
+
+            menu_cache.set_data(key[0], key[1], version, fresh)
+
+            return wrap_items(fragments)
+
+    stats['cache'] = 'miss'
+    items = freeze(_get_tree(context.get('request'), menu_name, group_name, key))
+    stats['nodes'] = count_nodes(items)
+
+    index = link_index(items)
+    active_path = find_active(index, url)
+    values = menu_cache.layout_values(items, index)
+    fragments = []
+
+    with measure_render(stats):
+        for item in items:
+            html = _render_fragment(context, item, flavor, active_path)
+            fragments.append(html)
+
+            if active_path is None or not active_path.startswith(item.path):
+                values[fragment_name(item.path)] = html
+
+    menu_cache.set_data(key[0], key[1], version, values)
+
+    return wrap_items(fragments)
+
+
+def _get_chain(items, path):
+    """ :returns: list of items from the root to the item with path """
+    chain = []
+
+    while path is not None:
+        item = next((item for item in items if path.startswith(item.path)), None)
+        if item is None:
+            break
+
+        chain.append(item)
+        if item.path == path:
+            break
+        items = item.children
+
+    return chain
+
+
+def _get_active_chain(context, menu_name, group_name, url, use_cache):
+    if isinstance(menu_name, MenuSnapshot):
+        return _get_chain(menu_name.items, _find_active(menu_name.items, url))
+
+    use_cache = use_cache and menu_cache.get_cache() is not None
+    key = _get_cache_key(menu_name, group_name)
+    version = None
+
+    if use_cache:
+        found, version = menu_cache.get_data(key[0], key[1], [menu_cache.LAYOUT])
+
+        if menu_cache.LAYOUT in found:
+            active_path = find_active(found[menu_cache.LAYOUT][0], url)
+            if active_path is None:
+                return []
+
+            name = ('subtree', active_path[:_get_steplen()])
+            found, version = menu_cache.get_data(key[0], key[1], [name], version)
+            if name in found:
+                return _get_chain([found[name]], active_path)
+
+    items = _get_tree(context.get('request'), menu_name, group_name, key)
+    index = link_index(items)
+
+    if use_cache:
+        items = freeze(items)
+        menu_cache.set_data(key[0], key[1], version, menu_cache.layout_values(items, index))
+
+    return _get_chain(items, find_active(index, url))
+
+
+@register.simple_tag(takes_context=True)
+def show_breadcrumbs(context, menu_name, group_name=None, **kwargs):
+    """
+    Renders items of the menu from the root to the item linking to the
+    current page (or its closest parent url), see ``active`` option of
+    :func:`show_menu`. Another url can be passed as ``url=``.
+
+    With ``PLAINMENU_CACHE`` set, the menu layout and subtrees cached by
+    ``show_menu`` are used, so no queries are made once they are cached.
+    """
+    request = context.get('request')
+    url = kwargs.get('url') or (request.path if request is not None else None)
+    items = _get_active_chain(context, menu_name, group_name, url, kwargs.get('cache', True)) if url else []
+
+    values = context.flatten()
+    values['items'] = items
     return template.loader.render_to_string(
-        template_name, context.flatten(), request=context['request']
+        kwargs.get('template') or BREADCRUMBS_TEMPLATE, values, request=request
     )
 
 
-@register.inclusion_tag('admin/tree_change_list_results.html', takes_context=True)
+@register.simple_tag(takes_context=True)
+def prefetch_menus(context, *identifiers, **kwargs):
+    """
+    Marks menus shown later on the page, so they are loaded all at once
+    by the first ``show_menu`` which needs any of them::
+
+        {% prefetch_menus 'header' 'footer' 'sidebar' group='main' %}
+    """
+    utils.prefetch_menus(context['request'], identifiers, kwargs.get('group'))
+    return ''
+
+
+def tree_results(cl, parent=None):
+    """
+    Rows of the admin menu tree. Parents are looked up among the listed
+    items (and parent, whose children are listed) instead of a query per row.
+
+    :returns: list of (pk, parent pk, depth, children count, loaded, cells),
+        loaded is false for items whose children are not listed
+    """
+    from treebeard.templatetags.admin_tree import items_for_result
+
+    ids = {parent.path: parent.pk} if parent is not None else {}
+    rows = []
+
+    for result in cl.result_list:
+        ids[result.path] = result.pk
+        parent_path = result.path[:-result.steplen]
+
+        if not parent_path:
+            parent_id = 0
+        elif parent_path in ids:
+            parent_id = ids[parent_path]
+        else:
+            parent_id = result.get_parent().pk
+
+        rows.append([result.pk, parent_id, result.depth, result.numchild, False, result])
+
+    parent_ids = set(row[1] for row in rows)
+
+    for row in rows:
+        row[4] = not row[3] or row[0] in parent_ids
+        row[5] = list(items_for_result(cl, row[5], None))
+
+    return rows
+
+
+@register.inclusion_tag('admin/plainmenu/tree_results.html', takes_context=True)
 def result_tree_pm(context, cl, request):
-    from treebeard.templatetags.admin_tree import result_tree as orig
+    from django.contrib.admin.templatetags.admin_list import result_headers, result_hidden_fields
+    from django.utils.translation import ugettext_lazy as _
+    from treebeard.templatetags import needs_checkboxes
+
+    headers = list(result_headers(cl))
+    headers.insert(1 if needs_checkboxes(context) else 0, {
+        'text': '+',
+        'sortable': True,
+        'url': request.path,
+        'tooltip': _('Return to ordered tree'),
+        'class_attrib': mark_safe(' class="oder-grabber"')
+    })
 
-    res = orig(context, cl, request)
-    res['filtered'] = False
-    return res
+    return {
+        'filtered': False,
+        'result_hidden_fields': list(result_hidden_fields(cl)),
+        'result_headers': headers,
+        'results': tree_results(cl),
+    }
@@ -0,0 +1,238 @@
+"""
+Export and import of whole menu trees as json lines.
+
+Every menu is written as a ``menu`` record followed by ``item`` records of
+its items in tree order, each referencing its parent by exported id::
+
+    {"type":"menu","identifier":"top","group":"main","fields":{"name":"Top"}}
+    {"type":"item","id":1,"parent":null,"fields":{"title":"Home","sort_weight":0}}
+
+Paths are not exported, they are computed again on import.
+"""
+from __future__ import unicode_literals
+
+import json
+
+import swapper
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models.query import QuerySet
+
+from .cache import invalidate_menu
+
+
+MENU_EXCLUDE = ('identifier', 'group')
+ITEM_EXCLUDE = ('path', 'depth', 'numchild', 'menu', 'normalized_link')
+
+
+class MenuImportError(ValueError):
+    pass
+
+
+_TEXT = type('')
+
+
+def _is_id(value):
+    return isinstance(value, (int, _TEXT)) and not isinstance(value, bool)
+
+
+def _get_fields(model, exclude):
+    return [
+        field for field in model._meta.concrete_fields
+        if not field.primary_key and field.name not in exclude
+    ]
+
+
+def _dump(record):
+    return json.dumps(record, cls=DjangoJSONEncoder, separators=(',', ':')) + '\n'
+
+
+def iter_menu_records(menu):
+    """ Yields json lines of the menu and its items, items are streamed from database """
+    Menu = swapper.load_model('plainmenu', 'Menu')
+    MenuItem = swapper.load_model('plainmenu', 'MenuItem')
+
+    yield _dump({
+        'type': 'menu',
+        'identifier': menu.identifier,
+        'group': menu.group.name if menu.group_id else None,
+        'fields': dict(
+            (field.attname, field.value_from_object(menu)) for field in _get_fields(Menu, MENU_EXCLUDE)
+        ),
+    })
+
+    fields = _get_fields(MenuItem, ITEM_EXCLUDE)
+    ids = {}
+
+    for item in MenuItem.objects.filter(menu=menu).order_by('path').iterator():
+        ids[item.path] = item.pk
+
+        yield _dump({
+            'type': 'item',
+            'id': item.pk,
+            'parent': ids.get(item.path[:-item.steplen]),
+            'fields': dict((field.attname, field.value_from_object(item)) for field in fields),
+        })
+
+
+def export_menus(menus, fp):
+    """ Writes menus with their items to file-like object """
+    for menu in menus:
+        for line in iter_menu_records(menu):
+            fp.write(line)
+
+
+def export_group(group, fp):
+    """ Writes all menus of the group to file-like object """
+    Menu = swapper.load_model('plainmenu', 'Menu')
+    export_menus(Menu.objects.filter(group=group).select_related('group').order_by('identifier'), fp)
+
+
+def import_menus(lines, group=None, batch_size=500):
+    """
+    Imports menus from json lines in one transaction. Existing menus with
+    the same identifier and group get their fields updated and items
+    replaced. Items are inserted with precomputed paths in batches.
+
+    :param lines: iterable of json lines, e.g. open file
+    :param group: group name to import all menus into instead of exported ones
+    :returns: list of imported menus
+    """
+    importer = _Importer(group, batch_size)
+
+    with transaction.atomic():
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise MenuImportError('Line {}: {}'.format(number, e))
+
+            importer.add(number, record)
+
+        importer.flush()
+
+    for menu in importer.menus:
+        invalidate_menu(menu)
+
+    return importer.menus
+
+
+class _Importer(object):
+    def __init__(self, group, batch_size):
+        self.Menu = swapper.load_model('plainmenu', 'Menu')
+        self.MenuItem = swapper.load_model('plainmenu', 'MenuItem')
+        self.Group = swapper.load_model('plainmenu', 'Group')
+
+        self.group = group
+        self.batch_size = batch_size
+        self.groups = {}
+        self.menus = []
+        self.menu = None
+        self.items = []
+        self.nodes = {}
+
+    def add(self, number, record):
+        if not isinstance(record, dict):
+            raise MenuImportError('Line {}: record must be an object'.format(number))
+
+        kind = record.get('type')
+        self.check(number, record)
+
+        if kind == 'menu':
+            self.flush()
+            self.start_menu(record)
+        elif kind == 'item':
+            if self.menu is None:
+                raise MenuImportError('Line {}: item before any menu'.format(number))
+            self.add_item(number, record)
+        else:
+            raise MenuImportError('Line {}: unknown record type {!r}'.format(number, kind))
+
+    def check(self, number, record):
+        """ Raises MenuImportError for records of known type with missing or malformed values """
+        kind = record.get('type')
+
+        if kind == 'menu':
+            checks = [
+                ('identifier must be a string', isinstance(record.get('identifier'), _TEXT)),
+                ('group must be a string or null', record.get('group') is None or isinstance(record['group'], _TEXT)),
+            ]
+        elif kind == 'item':
+            checks = [
+                ('id must be a number or string', _is_id(record.get('id'))),
+                ('parent must be a number, string or null', record.get('parent') is None or _is_id(record['parent'])),
+            ]
+        else:
+            return
+
+        checks.append(('fields must be an object', isinstance(record.get('fields', {}), dict)))
+
+        for message, valid in checks:
+            if not valid:
+                raise MenuImportError('Line {}: {} {}'.format(number, kind, message))
+
+    def get_group(self, name):
+        if name is None:
+            return None
+
+        if name not in self.groups:
+            self.groups[name] = self.Group.objects.get_or_create(name=name)[0]
+
+        return self.groups[name]
+
+    def start_menu(self, record):
+        group = self.get_group(self.group or record.get('group'))
+        menu = self.Menu.objects.filter(identifier=record['identifier'], group=group).first()
+
+        if menu is None:
+            menu = self.Menu(identifier=record['identifier'], group=group)
+        else:
+            # plain django delete, treebeard's one removes descendants by path across all menus
+            QuerySet.delete(self.MenuItem.objects.filter(menu=menu))
+
+        for field in _get_fields(self.Menu, MENU_EXCLUDE):
+            if field.attname in record.get('fields', {}):
+                setattr(menu, field.attname, field.to_python(record['fields'][field.attname]))
+
+        menu.save()
+
+        self.menu = menu
+        self.menus.append(menu)
+
+    def add_item(self, number, record):
+        parent = record.get('parent')
+
+        if parent is None:
+            parent_path, siblings = '', self.nodes.setdefault(None, [None, 0])
+        elif parent in self.nodes:
+            parent_node = self.nodes[parent]
+            parent_path, siblings = parent_node[0].path, parent_node
+        else:
+            raise MenuImportError('Line {}: unknown parent {!r}'.format(number, parent))
+
+        siblings[1] += 1
+        path = parent_path + self.MenuItem._get_path(None, 1, siblings[1])
+
+        item = self.MenuItem(menu=self.menu, path=path, depth=len(path) // self.MenuItem.steplen, numchild=0)
+        for field in _get_fields(self.MenuItem, ITEM_EXCLUDE):
+            if field.attname in record.get('fields', {}):
+                setattr(item, field.attname, field.to_python(record['fields'][field.attname]))
+
+        if parent is not None:
+            self.nodes[parent][0].numchild += 1
+
+        self.nodes[record['id']] = [item, 0]
+        self.items.append(item)
+
+    def flush(self):
+        if self.items:
+            self.MenuItem.objects.bulk_create(self.items, batch_size=self.batch_size)
+
+        self.menu = None
+        self.items = []
+        self.nodes = {}
@@ -0,0 +1,529 @@
+from __future__ import unicode_literals
+
+import sys
+import json
+from operator import attrgetter
+
+from django.db import connections, router
+from django.db.models import Q
+from django.db.models.functions import Substr
+from django.utils.translation import ugettext_noop as _
+
+from treebeard.exceptions import InvalidMoveToDescendant
+
+
+def build_tree(items, base_path=''):
+    """
+    Builds nested tree out of path-ordered menu items.
+
+    Every item gets ``children`` list attribute with its direct children,
+    sorted the same way as ``get_children()`` would return them.
+
+    :param base_path: path of the item whose children are roots of the tree
+    :returns: list of root items
+    """
+    roots = []
+    by_path = {}
+
+    for item in items:
+        item.children = []
+        by_path[item.path] = item
+
+        parent_path = item.path[:-item.steplen]
+
+        if parent_path == base_path:
+            roots.append(item)
+        elif parent_path in by_path:
+            parent = by_path[parent_path]
+            item._cached_parent_obj = parent
+            parent.children.append(item)
+        # items with missing parent are unreachable, same as with get_children()
+
+    if roots:
+        key = attrgetter(*roots[0].node_order_by)
+
+        roots.sort(key=key)
+        for item in by_path.values():
+            item.children.sort(key=key)
+
+    return roots
+
+
+class MenuNode(object):
+    """
+    Immutable lightweight copy of a menu item holding only render fields.
+
+    Quacks like a menu item with attached ``children`` in templates, values
+    of other fields from ``get_render_fields()`` (e.g. ``RENDER_EXTRA_FIELDS``)
+    are kept in ``extra`` and read as attributes.
+    """
+    __slots__ = ('pk', 'path', 'depth', 'title', 'hint', 'link', 'target', 'target_html', 'extra', 'children')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs.get(name))
+
+    def __getattr__(self, name):
+        extra = object.__getattribute__(self, 'extra')
+        if extra and name in extra:
+            return extra[name]
+
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+
+    def __str__(self):
+        return self.title
+
+    def __repr__(self):
+        return '<{}: {}>'.format(self.__class__.__name__, self.title)
+
+    def __reduce__(self):
+        return _node_from_data, (self.to_data(),)
+
+    def get_children(self):
+        return self.children
+
+    def to_data(self):
+        """ :returns: node as nested tuple of field values, children last """
+        return tuple(getattr(self, name) for name in self.__slots__[:-1]) + (
+            tuple(child.to_data() for child in self.children),
+        )
+
+    @classmethod
+    def from_data(cls, data):
+        kwargs = dict(zip(cls.__slots__[:-1], data))
+        kwargs['children'] = tuple(cls.from_data(child) for child in data[-1])
+        return cls(**kwargs)
+
+    def prune(self, max_depth):
+        """ :returns: copy of the node without descendants deeper than max_depth """
+        kwargs = dict((name, getattr(self, name)) for name in self.__slots__)
+        kwargs['children'] = tuple(child.prune(max_depth) for child in self.children) if self.depth < max_depth else ()
+        return self.__class__(**kwargs)
+
+    @classmethod
+    def from_item(cls, item, max_depth=None, extra_fields=None):
+        """ :param extra_fields: names of fields kept in ``extra``, see :func:`get_extra_fields` """
+        if extra_fields is None:
+            extra_fields = get_extra_fields(type(item))
+
+        return cls(
+            pk=item.pk,
+            path=item.path,
+            depth=item.depth,
+            title=item.title,
+            hint=item.hint,
+            link=item.link,
+            target=item.target,
+            target_html=item.target_html(),
+            extra=dict((name, getattr(item, name)) for name in extra_fields) or None,
+            children=(
+                freeze(item.children, max_depth, extra_fields) if max_depth is None or item.depth < max_depth else ()
+            ),
+        )
+
+
+def _node_from_data(data):
+    return MenuNode.from_data(data)
+
+
+def get_extra_fields(model):
+    """
+    :returns: attribute names of render fields of the item model which
+        aren't :class:`MenuNode` slots, foreign keys are kept as their ids
+    """
+    fields = model.get_render_fields()
+    return tuple(
+        field.attname for field in model._meta.concrete_fields
+        if (fields is None or field.name in fields) and not field.primary_key and field.name not in MenuNode.__slots__
+    )
+
+
+def freeze(items, max_depth=None, extra_fields=None):
+    """
+    :returns: tuple of immutable nodes for items built by :func:`build_tree`
+        (or for nodes), descendants deeper than max_depth are left out
+    """
+    return tuple(
+        (item if max_depth is None else item.prune(max_depth)) if isinstance(item, MenuNode)
+        else MenuNode.from_item(item, max_depth, extra_fields)
+        for item in items
+    )
+
+
+def get_depth_limit(base_depth, max_depth=None, levels=None):
+    """
+    :param base_depth: depth of the item whose children are shown, 0 for roots
+    :returns: depth of the deepest shown items or None for unlimited
+    """
+    limits = [limit for limit in (max_depth, base_depth + levels if levels is not None else None) if limit is not None]
+    return min(limits) if limits else None
+
+
+def find_node(items, root):
+    """
+    :param root: pk of the item or its link
+    :returns: first item in tree order matching root or None
+    """
+    from .links import normalize_link
+
+    link = None if isinstance(root, int) else normalize_link(root)
+    if link is None and not isinstance(root, int):
+        return None
+
+    for item in items:
+        if (item.pk == root) if link is None else (normalize_link(item.link) == link):
+            return item
+
+        found = find_node(item.children, root)
+        if found is not None:
+            return found
+
+    return None
+
+
+def select_subtree(items, root=None, max_depth=None, levels=None):
+    """
+    Cuts part of the loaded tree, see :meth:`AbstractMenu.get_tree`.
+
+    :returns: tuple of immutable nodes
+    """
+    base_depth = 0
+
+    if root is not None:
+        node = find_node(items, root)
+        if node is None:
+            return ()
+        items, base_depth = node.children, node.depth
+
+    return freeze(items, get_depth_limit(base_depth, max_depth, levels))
+
+
+def tree_data(items):
+    """ :returns: list of dicts with public fields of items and their ``children`` """
+    return [
+        {
+            'title': item.title,
+            'hint': item.hint,
+            'link': item.link,
+            'target': item.target,
+            'children': tree_data(item.children),
+        }
+        for item in items
+    ]
+
+
+def tree_json(items):
+    """ :returns: compact json of :func:`tree_data` """
+    return json.dumps(tree_data(items), separators=(',', ':'))
+
+
+def count_nodes(items):
+    """ :returns: number of items in the tree including descendants """
+    return sum(1 + count_nodes(item.children) for item in items)
+
+
+def tree_size(nodes):
+    """ :returns: approximate memory taken by the tree of nodes in bytes """
+    size = sys.getsizeof(nodes)
+
+    for node in nodes:
+        size += sys.getsizeof(node) + tree_size(node.children)
+        size += sum(sys.getsizeof(getattr(node, name)) for name in ('path', 'title', 'hint', 'link', 'target_html'))
+
+    return size
+
+
+class MenuSnapshot(object):
+    """
+    Compiled menu which can be rendered without touching the database.
+
+    Holds identifier and group name of the menu and its tree of
+    :class:`MenuNode`, can be dumped to compact json and loaded back.
+    """
+    __slots__ = ('identifier', 'group_name', 'items')
+
+    def __init__(self, identifier, group_name, items):
+        object.__setattr__(self, 'identifier', identifier)
+        object.__setattr__(self, 'group_name', group_name)
+        object.__setattr__(self, 'items', tuple(items))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+
+    def __reduce__(self):
+        return self.__class__, (self.identifier, self.group_name, self.items)
+
+    def __repr__(self):
+        return '<{}: {}/{}>'.format(self.__class__.__name__, self.group_name, self.identifier)
+
+    def __eq__(self, other):
+        return isinstance(other, MenuSnapshot) and self.to_data() == other.to_data()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def to_data(self):
+        return (self.identifier, self.group_name, tuple(item.to_data() for item in self.items))
+
+    @classmethod
+    def from_data(cls, data):
+        identifier, group_name, items = data
+        return cls(identifier, group_name, (MenuNode.from_data(item) for item in items))
+
+    def dumps(self):
+        return json.dumps(self.to_data(), separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, raw):
+        return cls.from_data(_to_tuples(json.loads(raw)))
+
+    def save(self, filename):
+        with open(filename, 'w') as fp:
+            fp.write(self.dumps())
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as fp:
+            return cls.loads(fp.read())
+
+
+def _to_tuples(data):
+    if isinstance(data, list):
+        return tuple(_to_tuples(value) for value in data)
+    return data
+
+
+class TreeEditor(object):
+    """
+    In-memory copy of loaded subtrees of a menu for rearranging items.
+
+    Tracks path, depth, sort weight and children count of every item and
+    writes the changed ones back in bulk with :meth:`save`.
+    """
+    FIELDS = ('path', 'depth', 'sort_weight', 'numchild')
+
+    #: prefix of temporary paths, it is out of the path alphabet
+    TEMP_PREFIX = '~'
+
+    def __init__(self, model, menu_id, items, prefixes=('',)):
+        self.model = model
+        self.menu_id = menu_id
+        self.steplen = model.steplen
+        self.by_pk = {}
+        self.by_path = {}
+        self.children = {None: []}
+        self.original = {}
+        self.orphans = []
+
+        for item in items:
+            self.by_pk[item.pk] = item
+            self.by_path[item.path] = item
+            self.children[item.pk] = []
+            self.original[item.pk] = tuple(getattr(item, field) for field in self.FIELDS)
+
+            parent_path = item.path[:-self.steplen]
+            if not parent_path:
+                self.children[None].append(item)
+            elif parent_path in self.by_path:
+                self.children[self.by_path[parent_path].pk].append(item)
+            elif any(parent_path.startswith(prefix) for prefix in prefixes):
+                self.orphans.append(item)
+
+    @classmethod
+    def load(cls, model, menu_id, parent_paths):
+        """
+        Loads subtrees under the given parent paths (including parents
+        themselves) with a single query, empty path stands for whole menu.
+        Only fields needed for positioning are fetched.
+        """
+        prefixes = []
+        for path in sorted(set(parent_paths)):
+            if not any(path.startswith(prefix) for prefix in prefixes):
+                prefixes.append(path)
+
+        queryset = model.objects.filter(menu_id=menu_id).order_by('path').only('menu', *cls.FIELDS)
+
+        if '' not in prefixes:
+            condition = Q()
+            for prefix in prefixes:
+                condition |= Q(path__startswith=prefix)
+            queryset = queryset.filter(condition)
+
+        return cls(model, menu_id, queryset, prefixes)
+
+    def get_children(self, parent):
+        """ :returns: ordered children of item, roots for None """
+        return self.children[parent.pk if parent is not None else None]
+
+    def get_parent(self, item):
+        return self.by_path.get(item.path[:-self.steplen])
+
+    def move(self, item, parent, index=None):
+        """ Moves item to be child of parent (None for root) at index, last by default """
+        old_siblings = self.get_children(self.get_parent(item))
+        old_siblings.remove(item)
+
+        siblings = self.get_children(parent)
+        siblings.insert(len(siblings) if index is None else index, item)
+
+        self.renumber(parent)
+
+    def renumber(self, parent):
+        """ Assigns consecutive paths to children of parent in their current order """
+        base = parent.path if parent is not None else ''
+
+        for i, item in enumerate(self.get_children(parent)):
+            path = base + self.model._get_path(None, 1, i + 1)
+            if path != item.path:
+                self._relocate(item, path)
+
+    def repair(self, parent=None, destructive=False):
+        """
+        Fixes depth and numchild of the loaded items, they are written by
+        :meth:`save`.
+
+        Destructive repair also attaches orphans to their closest existing
+        ancestor and renumbers every level under parent by sort weight.
+        """
+        for item in self.by_pk.values():
+            item.depth = len(item.path) // self.steplen
+
+        if not destructive:
+            return
+
+        for item in self.orphans:
+            path = item.path[:-self.steplen]
+            while path and path not in self.by_path:
+                path = path[:-self.steplen]
+            self.children[self.by_path[path].pk if path else None].append(item)
+        self.orphans = []
+
+        levels = [parent]
+        while levels:
+            level = levels.pop()
+            children = self.get_children(level)
+            children.sort(key=lambda item: (item.sort_weight, item.path))
+            self.renumber(level)
+            levels.extend(children)
+
+    def rearrange(self, moves):
+        """
+        Moves many items at once, every level is renumbered afterwards and
+        sort weights of rearranged levels follow their new order.
+
+        :param moves: list of (item, new parent or None for root, index
+            among new siblings or None for last), indexes are applied in
+            ascending order
+        """
+        parents = dict((item.pk, parent) for item, parent, index in moves)
+
+        for item, parent, index in moves:
+            seen = set()
+            node = parent
+            while node is not None:
+                if node.pk == item.pk or node.pk in seen:
+                    raise InvalidMoveToDescendant(_("Can't move node to a descendant."))
+                seen.add(node.pk)
+                node = parents[node.pk] if node.pk in parents else self.get_parent(node)
+
+        affected = set()
+        for item, parent, index in moves:
+            old_parent = self.get_parent(item)
+            self.get_children(old_parent).remove(item)
+            affected.add(old_parent)
+
+        for item, parent, index in sorted(moves, key=lambda move: sys.maxsize if move[2] is None else move[2]):
+            siblings = self.get_children(parent)
+            siblings.insert(len(siblings) if index is None else index, item)
+            affected.add(parent)
+
+        for parent in affected:
+            for i, item in enumerate(self.get_children(parent)):
+                item.sort_weight = i
+
+        levels = [None]
+        while levels:
+            level = levels.pop()
+            self.renumber(level)
+            levels.extend(self.get_children(level))
+
+    def _relocate(self, item, path):
+        children = self.children[item.pk]
+
+        if self.by_path.get(item.path) is item:
+            del self.by_path[item.path]
+        item.path = path
+        item.depth = len(path) // self.steplen
+        self.by_path[path] = item
+
+        for child in children:
+            self._relocate(child, path + child.path[-self.steplen:])
+
+    def get_changed(self):
+        for pk, item in self.by_pk.items():
+            item.numchild = len(self.children[pk])
+
+        return [
+            item for pk, item in self.by_pk.items()
+            if tuple(getattr(item, field) for field in self.FIELDS) != self.original[pk]
+        ]
+
+    def save(self):
+        """
+        Writes changed items with one ``UPDATE ... CASE`` per batch and a
+        single set-based update of paths. Changed paths are written with
+        temporary prefix first, so unique (path, menu) is never violated in
+        between.
+
+        :returns: list of changed items
+        """
+        changed = self.get_changed()
+        if not changed:
+            return changed
+
+        connection = connections[router.db_for_write(self.model)]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        pk_column = connection.ops.quote_name(self.model._meta.pk.column)
+        menu_column = connection.ops.quote_name(self.model._meta.get_field('menu').column)
+
+        # every row takes id and value for each field plus id in the IN clause
+        max_params = connection.features.max_query_params or 2000
+        batch_size = max(1, (max_params - 1) // (len(self.FIELDS) * 2 + 1))
+
+        with connection.cursor() as cursor:
+            for start in range(0, len(changed), batch_size):
+                batch = changed[start:start + batch_size]
+                assignments, params = [], []
+
+                for field in self.FIELDS:
+                    column = connection.ops.quote_name(self.model._meta.get_field(field).column)
+                    assignments.append('{} = CASE {} {} END'.format(
+                        column, pk_column, ' '.join(['WHEN %s THEN %s'] * len(batch))
+                    ))
+                    for item in batch:
+                        value = getattr(item, field)
+                        params.extend((item.pk, self.TEMP_PREFIX + value if field == 'path' else value))
+
+                params.append(self.menu_id)
+                params.extend(item.pk for item in batch)
+
+                cursor.execute('UPDATE {} SET {} WHERE {} = %s AND {} IN ({})'.format(
+                    table, ', '.join(assignments), menu_column, pk_column, ', '.join(['%s'] * len(batch))
+                ), params)
+
+        self.model.objects.filter(
+            menu_id=self.menu_id, path__startswith=self.TEMP_PREFIX
+        ).update(path=Substr('path', len(self.TEMP_PREFIX) + 1))
+
+        for item in changed:
+            self.original[item.pk] = tuple(getattr(item, field) for field in self.FIELDS)
+
+        return changed
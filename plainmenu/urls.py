@@ -0,0 +1,9 @@
+from django.conf.urls import url
+
+from .views import menu_json
+
+
+urlpatterns = [
+    url(r'^(?P<group>[^/]+)/(?P<identifier>[^/]+)\.json$', menu_json, name='plainmenu_menu_json'),
+    url(r'^(?P<identifier>[^/]+)\.json$', menu_json, name='plainmenu_menu_json'),
+]
@@ -0,0 +1,97 @@
+from __future__ import unicode_literals
+
+import swapper
+
+
+def get_menu(menu_name, group_name=None):
+    """
+    Finds menu by identifier within group given by name or instance.
+
+    Menus without group are looked up when group is not found.
+    """
+    Menu = swapper.load_model('plainmenu', 'Menu')
+    Group = swapper.load_model('plainmenu', 'Group')
+
+    if isinstance(menu_name, Menu):
+        return menu_name
+
+    if isinstance(group_name, Group):
+        group = group_name
+    elif group_name is not None:
+        try:
+            group = Group.objects.get(name=group_name)
+        except Group.DoesNotExist:
+            group = None
+    else:
+        group = None
+
+    try:
+        return Menu.objects.get(identifier=menu_name, group=group)
+    except Menu.DoesNotExist:
+        return None
+
+
+def prefetch_menus(request, identifiers, group=None):
+    """
+    Marks menus as shown on the page of the request.
+
+    Trees of all marked menus are loaded together the first time any of
+    them is needed, with one query for menus of each group and a single
+    query for items.
+
+    :param group: group name or instance
+    """
+    Group = swapper.load_model('plainmenu', 'Group')
+    group_name = group.name if isinstance(group, Group) else group
+
+    pending = request.__dict__.setdefault('_plainmenu_pending', {})
+    loaded = getattr(request, '_plainmenu_trees', {})
+
+    for identifier in identifiers:
+        if (identifier, group_name) not in loaded:
+            pending[(identifier, group_name)] = group
+
+
+def get_pending_keys(request):
+    """ :returns: list of (identifier, group name) of marked but not loaded menus """
+    return list(getattr(request, '_plainmenu_pending', {}))
+
+
+def get_prefetched_tree(request, key):
+    """
+    :param key: tuple of (identifier, group name)
+    :returns: prefetched tree of the menu or None if it wasn't marked
+    """
+    trees = request.__dict__.setdefault('_plainmenu_trees', {})
+
+    if key not in trees and key in getattr(request, '_plainmenu_pending', {}):
+        _load_pending(request)
+
+    return trees.get(key)
+
+
+def _load_pending(request):
+    Menu = swapper.load_model('plainmenu', 'Menu')
+    Group = swapper.load_model('plainmenu', 'Group')
+
+    pending = request._plainmenu_pending
+    request._plainmenu_pending = {}
+
+    by_group = {}
+    for (identifier, group_name), group in pending.items():
+        by_group.setdefault(group_name, (group, []))[1].append(identifier)
+
+    found = {}
+    for group_name, (group, identifiers) in by_group.items():
+        if group is not None and not isinstance(group, Group):
+            group = Group.objects.filter(name=group).first()
+
+        for menu in Menu.objects.filter(identifier__in=identifiers, group=group):
+            found[(menu.identifier, group_name)] = menu
+
+    trees = Menu.get_trees(found.values())
+    loaded = request.__dict__.setdefault('_plainmenu_trees', {})
+
+    for key in pending:
+        menu = found.get(key)
+        loaded[key] = trees[menu.pk] if menu else []
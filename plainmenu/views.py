@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_safe
+
+from . import cache as menu_cache, utils
+from .tree import tree_json
+
+
+def _etag(value):
+    return quote_etag(hashlib.md5(value.encode('utf-8')).hexdigest())
+
+
+def _conditional_response(request, etag):
+    """ :returns: 304 (or 412) response carrying the ETag or None when the body has to be sent """
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        response['ETag'] = etag
+
+    return response
+
+
+@require_safe
+def menu_json(request, identifier, group=None):
+    """
+    Serves tree of the menu found like :func:`~plainmenu.utils.get_menu`
+    as compact json, see :func:`~plainmenu.tree.tree_data`.
+
+    ETag is derived from the menu version with ``PLAINMENU_CACHE`` set, so
+    ``If-None-Match`` requests are answered with 304 without building the
+    tree, and the json itself is cached until the menu changes. Without
+    cache ETag is a hash of the json.
+    """
+    key = (identifier, group)
+    version = menu_cache.get_versions([key], request).get(key)
+    etag = _etag('{}:{}'.format(*version)) if version is not None else None
+
+    if etag is not None:
+        response = _conditional_response(request, etag)
+        if response is not None:
+            return response
+
+    found, version = menu_cache.get_data(identifier, group, [menu_cache.JSON], version)
+    body = found.get(menu_cache.JSON)
+
+    if body is None:
+        menu = utils.get_menu(identifier, group)
+        body = tree_json(menu.get_tree()) if menu is not None else ''
+        menu_cache.set_data(identifier, group, version, {menu_cache.JSON: body})
+
+    if not body:
+        raise Http404('No menu {!r} in group {!r}'.format(identifier, group))
+
+    if etag is None:
+        etag = _etag(body)
+        response = _conditional_response(request, etag)
+        if response is not None:
+            return response
+
+    response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    return response
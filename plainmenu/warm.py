@@ -0,0 +1,75 @@
+"""
+Filling the cache with menus ahead of requests, so workers don't all hit
+the database after a deploy, a cache flush or a menu change.
+"""
+from __future__ import unicode_literals
+
+import swapper
+
+from django.conf import settings as django_settings
+from django.db import transaction
+from django.template import loader
+from django.utils import translation
+
+from . import cache as menu_cache
+from .conf import settings
+from .links import link_index
+from .renderer import render_menu, DEFAULT_TEMPLATE
+from .tree import freeze, tree_json
+
+
+def warm_menu(menu, languages=None):
+    """
+    Stores data of the current version of the menu in the cache: html of
+    ``show_menu`` with default template and ``PLAINMENU_RENDERER``, layout
+    used by ``active`` option and breadcrumbs, and json of the menu api.
+    The tree is loaded with a single query.
+
+    :param languages: language codes to render html for, current one by default
+    :returns: False if cache is disabled
+    """
+    cache = menu_cache.get_cache()
+    if cache is None:
+        return False
+
+    identifier, group_name = menu.identifier, menu_cache.get_group_name(menu)
+    version = menu_cache.get_version(cache, identifier, group_name)
+    items = freeze(menu.get_tree())
+
+    flavor = 'fast' if settings.RENDERER == 'fast' else None
+    variant = menu_cache.rendered_variant(flavor)
+
+    for language in languages or [translation.get_language() or django_settings.LANGUAGE_CODE]:
+        with translation.override(language):
+            if flavor == 'fast':
+                html = render_menu(items)
+            else:
+                html = loader.render_to_string(DEFAULT_TEMPLATE, {
+                    'items': items, 'active_path': None, 'active_paths': (),
+                })
+            menu_cache.set_rendered(identifier, group_name, None, version, html, variant)
+
+    values = menu_cache.layout_values(items, link_index(items))
+    values[menu_cache.JSON] = tree_json(items)
+    menu_cache.set_data(identifier, group_name, version, values)
+
+    return True
+
+
+def warm_menus(menus, languages=None):
+    """ :returns: number of warmed menus """
+    return sum(1 for menu in menus if warm_menu(menu, languages))
+
+
+def warm_on_commit(menu_id):
+    """ Warms the menu once the transaction commits, if ``PLAINMENU_WARM_ON_SAVE`` is set """
+    if not settings.WARM_ON_SAVE or menu_cache.get_cache() is None:
+        return
+
+    def warm():
+        Menu = swapper.load_model('plainmenu', 'Menu')
+        menu = Menu.objects.select_related('group').filter(pk=menu_id).first()
+        if menu is not None:
+            warm_menu(menu)
+
+    transaction.on_commit(warm)
@@ -0,0 +1,35 @@
+from __future__ import unicode_literals
+
+from django import forms
+
+
+class ParentAutocompleteInput(forms.HiddenInput):
+    """
+    Picks parent item by searching titles at ``url`` instead of listing
+    every item of the menu in ``<select>``.
+
+    :param labels: dict of item pk -> label, used to show the current value
+    """
+    template_name = 'admin/plainmenu/widgets/parent_autocomplete.html'
+
+    class Media:
+        js = ('plainmenu/parent_autocomplete.js',)
+
+    def __init__(self, url, labels, attrs=None):
+        super(ParentAutocompleteInput, self).__init__(attrs)
+        self.url = url
+        self.labels = labels
+
+    def get_context(self, name, value, attrs):
+        context = super(ParentAutocompleteInput, self).get_context(name, value, attrs)
+
+        try:
+            label = self.labels.get(int(value), '')
+        except (TypeError, ValueError):
+            label = ''
+
+        context['widget'].update({
+            'url': self.url,
+            'label': label,
+        })
+        return context
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Benchmarks of menu rendering and admin tree operations.
+
+Runs against a throwaway test database of ``test_project`` settings and
+prints results as json, e.g.::
+
+    python benchmark.py --breadth 10 --depth 3 --repeat 20 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_project.settings')
+
+import django
+django.setup()
+
+import swapper
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.template import Context, Template
+from django.test import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+from django.urls import reverse
+
+import plainmenu
+
+Menu = swapper.load_model('plainmenu', 'Menu')
+MenuItem = swapper.load_model('plainmenu', 'MenuItem')
+Group = swapper.load_model('plainmenu', 'Group')
+
+
+class Rollback(Exception):
+    pass
+
+
+def make_menu(identifier, group, breadth, depth):
+    """ Creates menu with ``breadth`` children on each of ``depth`` levels """
+    menu = Menu.objects.create(identifier=identifier, name=identifier, group=group)
+    items = []
+
+    def add_level(parent_path, level):
+        for i in range(breadth):
+            path = parent_path + MenuItem._get_path(None, 1, i + 1)
+            items.append(MenuItem(
+                menu=menu, title='item {}'.format(path), link='/{}/'.format(path), sort_weight=i,
+                path=path, depth=level, numchild=breadth if level < depth else 0,
+            ))
+            if level < depth:
+                add_level(path, level + 1)
+
+    add_level('', 1)
+    MenuItem.objects.bulk_create(items, batch_size=500)
+
+    return menu, len(items)
+
+
+def measure(func, repeat, rollback=False):
+    """ :returns: dict with query count, wall times and allocations of func """
+
+    def run():
+        if not rollback:
+            return func()
+        try:
+            with transaction.atomic():
+                func()
+                raise Rollback
+        except Rollback:
+            pass
+
+    run()  # warm up
+
+    with CaptureQueriesContext(connection) as queries:
+        run()
+    query_count = len(queries)
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        run()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    timings.sort()
+
+    return {
+        'queries': query_count,
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'max': timings[-1],
+        'alloc_blocks': sum(stat.count_diff for stat in stats if stat.count_diff > 0),
+        'alloc_bytes': sum(stat.size_diff for stat in stats if stat.size_diff > 0),
+        'peak_bytes': peak,
+    }
+
+
+def run_benchmarks(breadth, depth, repeat):
+    group = Group.objects.create(name='benchmark')
+    menu, size = make_menu('main', group, breadth, depth)
+
+    request = RequestFactory().get('/')
+    show_menu = Template("{% load plainmenu %}{% show_menu 'main' 'benchmark' cache=False %}")
+
+    roots = list(menu.get_items())
+    first, last = roots[0], roots[-1]
+
+    User = get_user_model()
+    user = User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+    client = Client()
+    client.force_login(user)
+    change_url = reverse(
+        'admin:{}_{}_change'.format(Menu._meta.app_label, Menu._meta.model_name), args=(menu.pk,)
+    )
+
+    def move():
+        MenuItem.objects.get(pk=last.pk).move(MenuItem.objects.get(pk=first.pk), 'sorted-sibling')
+
+    def change_view():
+        response = client.get(change_url)
+        assert response.status_code == 200, response.status_code
+
+    benchmarks = [
+        ('show_menu', lambda: show_menu.render(Context({'request': request})), False),
+        ('get_items', lambda: list(menu.get_items()), False),
+        ('move', move, True),
+        ('fix_tree', lambda: MenuItem.objects.get(pk=first.pk).fix_tree(), True),
+        ('admin_change_view', change_view, False),
+    ]
+
+    results = {}
+    for name, func, rollback in benchmarks:
+        results[name] = measure(func, repeat, rollback)
+        sys.stderr.write('{}: {queries} queries, median {median:.4f}s\n'.format(name, **results[name]))
+
+    return size, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--breadth', type=int, default=5, help='children of every item')
+    parser.add_argument('--depth', type=int, default=3, help='levels of the menu')
+    parser.add_argument('--repeat', type=int, default=10, help='timed runs of every benchmark')
+    parser.add_argument('--output', help='file to write json results to, stdout by default')
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+
+    try:
+        size, results = run_benchmarks(args.breadth, args.depth, args.repeat)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    output = json.dumps({
+        'plainmenu': '.'.join(str(part) for part in plainmenu.__version__),
+        'django': django.get_version(),
+        'python': platform.python_version(),
+        'database': connection.vendor,
+        'breadth': args.breadth,
+        'depth': args.depth,
+        'items': size,
+        'repeat': args.repeat,
+        'results': results,
+    }, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,1320 @@
-from django.test import TestCase
+import os
+import json
+import shutil
+import pickle
+import tempfile
+from io import StringIO
 
-# Create your tests here.
+from django.template import Context, Template
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.db import connection, transaction
+from unittest import skipUnless
+
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+import swapper
+
+from treebeard.exceptions import InvalidMoveToDescendant, InvalidPosition
+
+from plainmenu import aio, cache as menu_cache, publish, transfer, warm
+from plainmenu.lru import LRUCache
+from plainmenu.renderer import render_menu
+from plainmenu.signals import menu_rendered, admin_view_rendered
+from plainmenu.tree import freeze, MenuNode, MenuSnapshot
+from plainmenu.widgets import ParentAutocompleteInput
+
+Menu = swapper.load_model('plainmenu', 'Menu')
+MenuItem = swapper.load_model('plainmenu', 'MenuItem')
+Group = swapper.load_model('plainmenu', 'Group')
+
+
+def make_items(menu, spec, parent_path='', depth=1):
+    """ Creates items from nested (title, children) spec with precomputed paths """
+    items = []
+    for i, (title, children) in enumerate(spec):
+        path = parent_path + MenuItem._get_path(None, 1, i + 1)
+        items.append(MenuItem(
+            menu=menu, title=title, link='/{}/'.format(title), sort_weight=i,
+            path=path, depth=depth, numchild=len(children),
+        ))
+        items.extend(make_items(menu, children, path, depth + 1))
+
+    if depth == 1:
+        MenuItem.objects.bulk_create(items)
+
+    return items
+
+
+def render(template, **context):
+    context.setdefault('request', RequestFactory().get('/'))
+    return Template('{% load plainmenu %}' + template).render(Context(context))
+
+
+class ShowMenuTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [
+            ('a', [('a1', []), ('a2', [('a21', [])])]),
+            ('b', []),
+        ])
+
+    def test_get_tree(self):
+        tree = self.menu.get_tree()
+
+        self.assertEqual([item.title for item in tree], ['a', 'b'])
+        self.assertEqual([item.title for item in tree[0].children], ['a1', 'a2'])
+        self.assertEqual([item.title for item in tree[0].children[1].children], ['a21'])
+        self.assertEqual(tree[0].children[1].get_parent(), tree[0])
+
+    def test_only_render_fields_are_loaded(self):
+        def tree_sql():
+            with CaptureQueriesContext(connection) as queries:
+                self.menu.get_tree()
+            return queries[0]['sql']
+
+        self.assertIn('"title"', tree_sql())
+        self.assertNotIn('test_field', tree_sql())
+        self.assertNotIn('test_field', str(self.menu.get_items().query))
+
+        with override_settings(PLAINMENU_RENDER_EXTRA_FIELDS=('test_field',)):
+            self.assertIn('test_field', tree_sql())
+            self.assertNotIn('normalized_link', tree_sql())
+
+        with override_settings(PLAINMENU_RENDER_EXTRA_FIELDS='__all__'):
+            self.assertIn('normalized_link', tree_sql())
+
+    def test_render(self):
+        html = render("{% show_menu 'top' 'main' %}")
+
+        self.assertEqual(html.count('<ul'), 3)
+        self.assertIn('<a href="/a21/" >a21</a>', html)
+        self.assertLess(html.index('a1'), html.index('a2'))
+
+    def test_template_with_get_items(self):
+        html = render("{% include 'plainmenu/menu.html' with items=menu.get_items %}", menu=self.menu)
+
+        self.assertEqual(html, render("{% show_menu 'top' 'main' %}"))
+        self.assertEqual([item.title for item in self.menu.get_items()[0].children], ['a1', 'a2'])
+
+    def test_query_count_does_not_depend_on_tree_size(self):
+        with self.assertNumQueries(3):
+            render("{% show_menu 'top' 'main' %}")
+
+        make_items(Menu.objects.create(identifier='big', name='Big', group=self.group), [
+            (str(i), [(str(i) + str(j), []) for j in range(5)]) for i in range(10)
+        ])
+
+        with self.assertNumQueries(3):
+            render("{% show_menu 'big' 'main' %}")
+
+
+class MenuSnapshotTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [('a', [('a1', [])]), ('b', [])])
+        MenuItem.objects.filter(title='a1').update(target=MenuItem.TARGET_BLANK)
+
+    def test_serialization(self):
+        snapshot = self.menu.compile()
+
+        self.assertEqual(MenuSnapshot.loads(snapshot.dumps()), snapshot)
+        self.assertEqual(pickle.loads(pickle.dumps(snapshot)), snapshot)
+        self.assertEqual(snapshot.items[0].children[0].target_html, 'target="_blank"')
+
+    def test_render_without_database(self):
+        snapshot = MenuSnapshot.loads(self.menu.compile().dumps())
+
+        with self.assertNumQueries(0):
+            html = render('{% show_menu snapshot %}', snapshot=snapshot)
+
+        self.assertEqual(html, render("{% show_menu 'top' 'main' %}"))
+
+
+class FastRendererTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [('a', [('a1', [('a11', [])]), ('a2', [])]), ('b', [])])
+        MenuItem.objects.filter(title='a1').update(target=MenuItem.TARGET_BLANK, title='<a1> & "co"')
+        MenuItem.objects.filter(title='b').update(link='')
+
+    def test_same_markup_as_template(self):
+        expected = render("{% show_menu 'top' 'main' %}")
+
+        self.assertEqual(render("{% show_menu 'top' 'main' renderer='fast' %}"), expected)
+        self.assertEqual(render_menu(self.menu.get_tree()), expected)
+        self.assertEqual(render_menu(self.menu.compile().items), expected)
+
+        with override_settings(PLAINMENU_RENDERER='fast'):
+            self.assertEqual(render("{% show_menu 'top' 'main' %}"), expected)
+
+    def test_custom_template_uses_template_engine(self):
+        with override_settings(PLAINMENU_RENDERER='fast'):
+            html = render("{% show_menu 'top' 'main' template='index.html' %}", menu_list=[])
+
+        self.assertIn('<h1>Menu test</h1>', html)
+
+
+class ActiveMenuTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [('a', [('a1', [('a11', [])]), ('a2', [])]), ('b', []), ('c', [])])
+
+    def render_at(self, path, template="{% show_menu 'top' 'main' active=True %}"):
+        return render(template, request=RequestFactory().get(path))
+
+    def test_active_path(self):
+        html = self.render_at('/a1/')
+
+        self.assertIn('<li class="active">\n<a href="/a1/"', html)
+        self.assertIn('<li class="expanded">\n<a href="/a/"', html)
+        self.assertEqual(html.count('<li class="'), 2)
+
+        self.assertIn('<li class="active">\n<a href="/b/"', self.render_at('/b/some/page/?x=1'))
+        self.assertNotIn('<li class="', self.render_at('/unknown/'))
+        self.assertIn(
+            '<li class="active">\n<a href="/c/"', render("{% show_menu 'top' 'main' active='/c/' %}")
+        )
+
+    def test_fast_renderer(self):
+        expected = self.render_at('/a11/')
+
+        self.assertEqual(self.render_at('/a11/', "{% show_menu 'top' 'main' active=True renderer='fast' %}"), expected)
+        self.assertEqual(self.render_at('/a11/', "{% show_menu 'top' 'main' active=True cache=False %}"), expected)
+
+    @override_settings(PLAINMENU_CACHE='default')
+    def test_fragments_are_cached(self):
+        with override_settings(PLAINMENU_CACHE=None):
+            expected = [self.render_at(path) for path in ('/a1/', '/b/', '/x/')]
+
+        self.render_at('/a1/')
+
+        with self.assertNumQueries(0):
+            self.assertEqual([self.render_at(path) for path in ('/a1/', '/b/', '/x/')], expected)
+
+        item = MenuItem.objects.get(title='c')
+        item.title = 'changed'
+        item.save()
+
+        self.assertIn('changed', self.render_at('/b/'))
+
+    @override_settings(PLAINMENU_CACHE='default', TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': False,
+        'OPTIONS': {'loaders': [
+            ('django.template.loaders.locmem.Loader', {
+                'plainmenu/menu.html': '{% for item in items %}[{{ item.title }}{% if item.path == active_path %}*{% endif %}]{% endfor %}',
+            }),
+            'django.template.loaders.app_directories.Loader',
+        ]},
+    }])
+    def test_overridden_template(self):
+        self.assertEqual(self.render_at('/b/'), '[a][b*][c]')
+        self.assertEqual(self.render_at('/c/'), '[a][b][c*]')
+
+
+class PartialMenuTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [('a', [('a1', [('a11', [])]), ('a2', [])]), ('b', [('b1', [])])])
+
+    def titles(self, items):
+        return [(item.title, self.titles(item.children)) for item in items]
+
+    def test_get_tree(self):
+        with CaptureQueriesContext(connection) as queries:
+            tree = self.menu.get_tree(max_depth=2)
+
+        self.assertEqual(self.titles(tree), [('a', [('a1', []), ('a2', [])]), ('b', [('b1', [])])])
+        self.assertIn('depth', queries[0]['sql'].split('WHERE')[1])
+
+        with self.assertNumQueries(2):
+            tree = self.menu.get_tree(root='/a/', levels=1)
+        self.assertEqual(self.titles(tree), [('a1', []), ('a2', [])])
+
+        root = MenuItem.objects.get(title='a1').pk
+        self.assertEqual(self.titles(self.menu.get_tree(root=root)), [('a11', [])])
+        self.assertEqual(self.menu.get_tree(root='/unknown/'), [])
+
+    def test_select_subtree(self):
+        snapshot = self.menu.compile()
+
+        self.assertEqual(
+            render("{% show_menu snapshot root='/a/' levels=1 %}", snapshot=snapshot),
+            render("{% show_menu 'top' 'main' root='/a/' levels=1 %}")
+        )
+        self.assertEqual(
+            render("{% show_menu snapshot max_depth=1 %}", snapshot=snapshot),
+            render("{% show_menu 'top' 'main' max_depth=1 %}")
+        )
+
+    def test_render(self):
+        html = render("{% show_menu 'top' 'main' root='/a/' %}")
+
+        self.assertIn('>a11</a>', html)
+        self.assertNotIn('>a</a>', html)
+        self.assertNotIn('>b1</a>', html)
+
+        html = render("{% show_menu 'top' 'main' max_depth=1 active='/a/x/' %}")
+        self.assertIn('<li class="active">\n<a href="/a/"', html)
+        self.assertNotIn('a1', html)
+
+    @override_settings(PLAINMENU_CACHE='default')
+    def test_parts_are_cached_apart(self):
+        whole = render("{% show_menu 'top' 'main' %}")
+        part = render("{% show_menu 'top' 'main' levels=1 %}")
+
+        self.assertNotEqual(whole, part)
+        with self.assertNumQueries(0):
+            self.assertEqual(render("{% show_menu 'top' 'main' levels=1 %}"), part)
+            self.assertEqual(render("{% show_menu 'top' 'main' %}"), whole)
+
+    @override_settings(PLAINMENU_CACHE='default', PLAINMENU_LRU_SIZE=10)
+    def test_tree_cache(self):
+        render("{% show_menu 'top' 'main' %}")
+
+        with self.assertNumQueries(0):
+            html = render("{% show_menu 'top' 'main' root='/b/' %}")
+        self.assertIn('>b1</a>', html)
+        self.assertNotIn('>a1</a>', html)
+
+
+class PublishTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [('a', [('a1', [])]), ('b', [])])
+        Menu.objects.create(identifier='top', name='Other')
+
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.settings = override_settings(PLAINMENU_PUBLISH_DIR=self.dir)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def test_publish(self):
+        expected = render("{% show_menu 'top' 'main' %}")
+        call_command('publish_menus', stdout=StringIO())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(render("{% show_menu 'top' 'main' published=True %}"), expected)
+
+        with open(publish.get_published_path('top', 'main', ext='json')) as fp:
+            self.assertEqual(json.load(fp)[0]['children'][0]['title'], 'a1')
+
+        self.assertTrue(os.path.exists(publish.get_published_path('top', None)))
+        publish.unpublish_menu('top', 'main')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'group-main'))), [])
+
+        with self.assertNumQueries(3):
+            self.assertEqual(render("{% show_menu 'top' 'main' published=True %}"), expected)
+
+    def test_changed_file_is_read_again(self):
+        publish.publish_menu(self.menu)
+        path = publish.get_published_path('top', 'main')
+        render("{% show_menu 'top' 'main' published=True %}")
+
+        with open(path, 'w') as fp:
+            fp.write('<ul>changed</ul>')
+        os.utime(path, (0, 0))
+
+        self.assertEqual(render("{% show_menu 'top' 'main' published=True %}"), '<ul>changed</ul>')
+
+    @override_settings(PLAINMENU_PUBLISH_ON_SAVE=True)
+    def test_publish_on_save(self):
+        MenuItem.objects.filter(title='b').update(title='changed')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            publish.publish_on_commit(self.menu.pk)
+
+        self.assertIn('changed', publish.read_published('top', 'main'))
+
+    @override_settings(PLAINMENU_PUBLISH_ON_SAVE=True)
+    def test_every_published_language_is_republished(self):
+        publish.publish_menus([self.menu], ['en-us', 'de'])
+        MenuItem.objects.filter(title='b').update(title='changed')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            publish.publish_on_commit(self.menu.pk)
+
+        self.assertIn('changed', publish.read_published('top', 'main', 'de'))
+        self.assertIn('changed', publish.read_published('top', 'main', 'en-us'))
+
+    @override_settings(PLAINMENU_PUBLISH_ON_SAVE=True)
+    def test_admin_rename_and_delete(self):
+        publish.publish_menus([self.menu], ['en-us', 'de'])
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        url = reverse('admin:{}_{}_change'.format(Menu._meta.app_label, Menu._meta.model_name), args=[self.menu.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'identifier': 'renamed', 'name': 'Top', 'group': self.group.pk, 'test_field': ''})
+        self.assertEqual(response.status_code, 302)
+
+        self.assertIsNone(publish.read_published('top', 'main', 'de'))
+        self.assertEqual(publish.get_published_languages('renamed', 'main'), ['de', 'en-us'])
+
+        url = reverse('admin:{}_{}_delete'.format(Menu._meta.app_label, Menu._meta.model_name), args=[self.menu.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {'post': 'yes'})
+
+        self.assertFalse(Menu.objects.filter(pk=self.menu.pk).exists())
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'group-main')), [])
+
+
+class MenuJsonTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [('a', [('a1', [])]), ('b', [])])
+        self.url = reverse('plainmenu_menu_json', kwargs={'group': 'main', 'identifier': 'top'})
+
+    def test_json(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.json()[0]['children'][0], {
+            'title': 'a1', 'hint': '', 'link': '/a1/', 'target': MenuItem.TARGET_NONE, 'children': [],
+        })
+        self.assertEqual(self.client.get(reverse('plainmenu_menu_json', kwargs={'identifier': 'missing'})).status_code, 404)
+
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+
+    @override_settings(PLAINMENU_CACHE='default')
+    def test_etag_follows_version(self):
+        etag = self.client.get(self.url)['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual((response.status_code, response['ETag']), (304, etag))
+            self.assertEqual(self.client.get(self.url)['ETag'], etag)
+
+        item = MenuItem.objects.get(title='b')
+        item.title = 'changed'
+        item.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()[1]['title'], 'changed')
+
+
+class LinkLookupTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [('a', [('a1', [('a11', [])]), ('a2', [])]), ('b', [])])
+        self.other = Menu.objects.create(identifier='other', name='Other')
+        make_items(self.other, [('x', [('a11', [])])])
+
+    def test_normalized_link(self):
+        self.assertEqual(MenuItem.objects.get(menu=self.menu, title='a11').normalized_link, '/a11/')
+
+        item = MenuItem.objects.get(title='b')
+        item.link = '/b/page?q=1#top'
+        item.save()
+        self.assertEqual(MenuItem.objects.get(title='b').normalized_link, '/b/page/')
+
+        MenuItem.objects.filter(title='a2').update(link='http://example.com/a2')
+        self.assertEqual(MenuItem.refresh_normalized_links(self.menu.pk), 1)
+        self.assertEqual(MenuItem.objects.get(title='a2').normalized_link, '//example.com/a2/')
+
+    def test_for_url(self):
+        with self.assertNumQueries(2):
+            items = MenuItem.objects.for_url('/a11/')
+
+        self.assertEqual([(item.menu_id, item.title) for item in items], [(self.menu.pk, 'a11'), (self.other.pk, 'a11')])
+        self.assertEqual([ancestor.title for ancestor in items[0].ancestors], ['a', 'a1'])
+        self.assertEqual([ancestor.title for ancestor in items[1].ancestors], ['x'])
+
+        self.assertEqual([item.menu_id for item in MenuItem.objects.for_url('/a11/', group='main')], [self.menu.pk])
+        self.assertEqual([item.title for item in MenuItem.objects.for_url('/a2/some/page/', group=self.group)], ['a2'])
+        self.assertEqual(MenuItem.objects.for_url('/unknown/'), [])
+
+    def test_breadcrumbs(self):
+        request = RequestFactory().get('/a11/')
+
+        html = render("{% show_breadcrumbs 'top' 'main' %}", request=request)
+        self.assertIn('<li><a href="/a/">a</a></li>', html)
+        self.assertIn('<li><a href="/a1/">a1</a></li>', html)
+        self.assertIn('<li>a11</li>', html)
+
+        self.assertEqual(render("{% show_breadcrumbs 'top' 'main' url='/unknown/' %}").strip(), '')
+
+        with override_settings(PLAINMENU_CACHE='default'):
+            render("{% show_menu 'top' 'main' active=True %}", request=request)
+
+            with self.assertNumQueries(0):
+                self.assertEqual(render("{% show_breadcrumbs 'top' 'main' %}", request=request), html)
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [('a', [('a1', [])]), ('b', [])])
+
+        self.calls = []
+        menu_rendered.connect(self.receiver)
+        admin_view_rendered.connect(self.receiver)
+
+    def tearDown(self):
+        menu_rendered.disconnect(self.receiver)
+        admin_view_rendered.disconnect(self.receiver)
+
+    def receiver(self, signal, stats, **kwargs):
+        kwargs.pop('sender')
+        self.calls.append((kwargs, stats))
+
+    def test_show_menu(self):
+        render("{% show_menu 'top' 'main' %}")
+
+        info, stats = self.calls[0]
+        self.assertEqual(info, {'identifier': 'top', 'group_name': 'main'})
+        self.assertEqual(stats['queries'], 3)
+        self.assertEqual(stats['nodes'], 3)
+        self.assertIsNone(stats['cache'])
+        self.assertGreater(stats['time'], stats['render_time'])
+
+    @override_settings(PLAINMENU_CACHE='default')
+    def test_cache_hit(self):
+        cache.clear()
+        render("{% show_menu 'top' 'main' %}")
+        render("{% show_menu 'top' 'main' %}")
+
+        self.assertEqual([stats['cache'] for info, stats in self.calls], ['miss', 'hit'])
+        self.assertEqual(self.calls[1][1]['queries'], 0)
+
+    def test_admin_change_view(self):
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.force_login(user)
+
+        response = self.client.get(reverse('admin:test_app_menu_change', args=(self.menu.pk,)))
+
+        self.assertEqual(response.status_code, 200)
+        info, stats = self.calls[-1]
+        self.assertEqual(info, {'view': 'menu_change', 'object_id': str(self.menu.pk)})
+        self.assertGreater(stats['queries'], 0)
+
+    def test_admin_item_change_view(self):
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        item = MenuItem.objects.get(title='a1')
+
+        response = self.client.get(reverse('admin:test_app_menuitem_change', args=(self.menu.pk, item.pk)))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.calls[-1][0], {'view': 'item_change', 'object_id': str(item.pk)})
+
+
+class PrefetchMenusTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='main')
+        for identifier in ('header', 'footer', 'sidebar'):
+            menu = Menu.objects.create(identifier=identifier, name=identifier, group=self.group)
+            make_items(menu, [(identifier + '1', [(identifier + '11', [])]), (identifier + '2', [])])
+
+    def test_prefetched_menus_are_loaded_together(self):
+        template = (
+            "{% prefetch_menus 'header' 'footer' 'sidebar' 'missing' group='main' %}"
+            "{% show_menu 'header' 'main' %}{% show_menu 'footer' 'main' %}"
+            "{% show_menu 'sidebar' 'main' %}{% show_menu 'missing' 'main' %}"
+        )
+
+        with self.assertNumQueries(3):
+            html = render(template)
+
+        self.assertEqual(html, render(
+            "{% show_menu 'header' 'main' %}{% show_menu 'footer' 'main' %}"
+            "{% show_menu 'sidebar' 'main' %}{% show_menu 'missing' 'main' %}"
+        ))
+
+    async def test_async_prefetch(self):
+        request = RequestFactory().get('/')
+        await aio.aprefetch_menus(request, ['header', 'footer', 'missing'], group='main')
+
+        # the ORM refuses queries from the event loop, rendering must not need any
+        html = render("{% show_menu 'header' 'main' %}{% show_menu 'missing' 'main' %}", request=request)
+        self.assertIn('>header11</a>', html)
+
+        tree = await aio.aget_tree('sidebar', 'main', max_depth=1)
+        self.assertEqual([(item.title, item.children) for item in tree], [('sidebar1', []), ('sidebar2', [])])
+        self.assertEqual(await aio.aget_tree('missing', 'main'), [])
+
+    def test_get_trees(self):
+        menus = list(Menu.objects.order_by('identifier'))
+
+        with self.assertNumQueries(1):
+            trees = Menu.get_trees(menus)
+
+        self.assertEqual([item.title for item in trees[menus[0].pk][0].children], ['footer11'])
+
+
+def dump_tree(menu):
+    """ :returns: nested (title, children) spec of menu, checking stored positions on the way """
+    def dump(items, parent_path):
+        for i, item in enumerate(items):
+            assert item.path[:-item.steplen] == parent_path, item.path
+            assert item.depth == len(item.path) // item.steplen, item.path
+            assert item.numchild == len(item.children), item.path
+        return [(item.title, dump(item.children, item.path)) for item in items]
+
+    return dump(menu.get_tree(), '')
+
+
+class MoveTest(TestCase):
+    def setUp(self):
+        self.menu = Menu.objects.create(identifier='top', name='Top')
+        make_items(self.menu, [
+            ('a', [('a1', []), ('a2', [('a21', [])])]),
+            ('b', []),
+            ('c', [('c1', [])]),
+        ])
+        other = Menu.objects.create(identifier='other', name='Other')
+        make_items(other, [('a', [('a1', [])]), ('b', [])])
+        self.other_tree = dump_tree(other)
+        self.other = other
+
+    def move(self, title, target, pos):
+        get = lambda title: MenuItem.objects.get(menu=self.menu, title=title)
+        get(title).move(get(target), pos)
+
+    def test_add_is_limited_to_menu(self):
+        third = Menu.objects.create(identifier='third', name='Third')
+        make_items(third, [('p', []), ('q', []), ('r', [])])
+
+        a = MenuItem.objects.get(menu=self.menu, title='a')
+        with CaptureQueriesContext(connection) as queries:
+            a.add_sibling('sorted-sibling', menu=self.menu, title='x', sort_weight=1)
+
+        update = next(query['sql'] for query in queries if query['sql'].startswith('UPDATE'))
+        self.assertIn('WHERE "menu_id" = ', update)
+
+        MenuItem.objects.get(menu=self.menu, title='b').add_child(menu=self.menu, title='b1', sort_weight=0)
+
+        self.assertEqual(
+            list(MenuItem.objects.filter(menu=self.menu, depth=1).order_by('path').values_list('title', flat=True)),
+            ['a', 'b', 'x', 'c']
+        )
+        self.assertEqual(
+            [(item.title, [child.title for child in item.children]) for item in self.menu.get_tree()][1], ('b', ['b1'])
+        )
+        self.assertEqual(dump_tree(third), [('p', []), ('q', []), ('r', [])])
+        self.assertEqual(dump_tree(self.other), self.other_tree)
+
+    def test_sibling_move(self):
+        self.move('c', 'a', 'sorted-sibling')
+
+        self.assertEqual(dump_tree(self.menu), [
+            ('c', [('c1', [])]),
+            ('a', [('a1', []), ('a2', [('a21', [])])]),
+            ('b', []),
+        ])
+        self.assertEqual(dump_tree(self.other), self.other_tree)
+
+    def test_move_to_another_parent(self):
+        self.move('a2', 'c1', 'sorted-sibling')
+        self.move('b', 'a1', 'sorted-child')
+
+        self.assertEqual(dump_tree(self.menu), [
+            ('a', [('a1', [('b', [])])]),
+            ('c', [('a2', [('a21', [])]), ('c1', [])]),
+        ])
+        self.assertEqual(dump_tree(self.other), self.other_tree)
+
+    def test_move_to_root(self):
+        self.move('a21', 'b', 'sorted-sibling')
+
+        self.assertEqual(dump_tree(self.menu), [
+            ('a', [('a1', []), ('a2', [])]),
+            ('a21', []),
+            ('b', []),
+            ('c', [('c1', [])]),
+        ])
+
+    def test_move_to_descendant(self):
+        with self.assertRaises(InvalidMoveToDescendant):
+            self.move('a', 'a21', 'sorted-child')
+
+    def test_query_count_does_not_depend_on_siblings(self):
+        menu = Menu.objects.create(identifier='big', name='Big')
+        make_items(menu, [(str(i), [(str(i) + 'x', [])]) for i in range(100)])
+        first, last = MenuItem.objects.get(menu=menu, title='0'), MenuItem.objects.get(menu=menu, title='99')
+
+        with CaptureQueriesContext(connection) as queries:
+            last.move(first, 'sorted-sibling')
+
+        # savepoint, select, bulk update batches, path update, release
+        self.assertLessEqual(len(queries), 7)
+
+        self.assertEqual([title for title, _ in dump_tree(menu)][:3], ['99', '0', '1'])
+
+
+class RepairTreeTest(TestCase):
+    def setUp(self):
+        self.menu = Menu.objects.create(identifier='top', name='Top')
+        make_items(self.menu, [('a', [('a1', []), ('a2', [('a21', [])])]), ('b', [])])
+        self.other = Menu.objects.create(identifier='other', name='Other')
+        make_items(self.other, [('a', [('a1', [])])])
+
+    def break_tree(self):
+        MenuItem.objects.filter(menu=self.menu, title='a').update(numchild=5)
+        MenuItem.objects.filter(menu=self.menu, title='a21').update(depth=1)
+        MenuItem.objects.filter(menu=self.other, title='a').update(numchild=5)
+
+    def test_find_problems(self):
+        self.break_tree()
+        problems = MenuItem.find_tree_problems(self.menu.pk)
+
+        self.assertEqual(problems['wrong_numchild'], [MenuItem.objects.get(menu=self.menu, title='a').pk])
+        self.assertEqual(problems['wrong_depth'], [MenuItem.objects.get(title='a21').pk])
+        self.assertEqual(problems['orphans'], [])
+
+    def test_fix_tree_is_scoped(self):
+        self.break_tree()
+
+        MenuItem.objects.get(menu=self.menu, title='a').fix_tree()
+
+        self.assertFalse(any(MenuItem.find_tree_problems(self.menu.pk).values()))
+        self.assertEqual(MenuItem.objects.get(menu=self.other, title='a').numchild, 5)
+
+    def test_destructive_repair(self):
+        MenuItem.objects.filter(menu=self.menu, title='a2').update(path='0009')
+        MenuItem.objects.filter(menu=self.menu, title='b').update(sort_weight=0)
+        MenuItem.objects.filter(menu=self.menu, title='a').update(sort_weight=1)
+        self.assertEqual(len(MenuItem.find_tree_problems(self.menu.pk)['orphans']), 1)
+
+        MenuItem.repair_tree(self.menu.pk, destructive=True)
+
+        self.assertEqual(dump_tree(self.menu), [('b', []), ('a', [('a1', []), ('a21', [])]), ('a2', [])])
+        self.assertFalse(any(MenuItem.find_tree_problems(self.menu.pk).values()))
+
+    def test_command(self):
+        self.break_tree()
+        out = StringIO()
+
+        with self.assertRaises(CommandError):
+            call_command('fix_menu_tree', '--check', stdout=out)
+
+        call_command('fix_menu_tree', str(self.menu.pk), stdout=out)
+
+        self.assertFalse(any(MenuItem.find_tree_problems(self.menu.pk).values()))
+        self.assertTrue(any(MenuItem.find_tree_problems(self.other.pk).values()))
+
+        call_command('fix_menu_tree', '--batch-size', '1', stdout=out)
+        self.assertFalse(any(MenuItem.find_tree_problems(self.other.pk).values()))
+
+    def test_command_selects_menus(self):
+        self.break_tree()
+        self.other.group = Group.objects.create(name='main')
+        self.other.save()
+
+        with self.assertRaisesRegex(CommandError, 'Menus not found: 999'):
+            call_command('fix_menu_tree', str(self.menu.pk), '999', stdout=StringIO())
+
+        call_command('fix_menu_tree', '--group', 'main', stdout=StringIO())
+
+        self.assertTrue(any(MenuItem.find_tree_problems(self.menu.pk).values()))
+        self.assertFalse(any(MenuItem.find_tree_problems(self.other.pk).values()))
+
+
+class TransferTest(TestCase):
+    def setUp(self):
+        group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=group, test_field='menu')
+        make_items(self.menu, [('a', [('a1', []), ('a2', [('a21', [])])]), ('b', [])])
+        MenuItem.objects.filter(title='a21').update(test_field='extra')
+
+    def export(self):
+        out = StringIO()
+        transfer.export_group(self.menu.group, out)
+        return out.getvalue()
+
+    def test_roundtrip_into_other_group(self):
+        data = self.export()
+
+        with self.assertNumQueries(9):
+            menus = transfer.import_menus(StringIO(data), group='staging')
+
+        self.assertEqual(len(menus), 1)
+        menu = Menu.objects.get(identifier='top', group__name='staging')
+        self.assertEqual((menu.name, menu.test_field), ('Top', 'menu'))
+        self.assertEqual(dump_tree(menu), dump_tree(self.menu))
+        self.assertEqual(MenuItem.objects.get(menu=menu, title='a21').test_field, 'extra')
+
+    def test_import_replaces_items(self):
+        data = self.export()
+        MenuItem.objects.filter(title='b').delete()
+        Menu.objects.filter(pk=self.menu.pk).update(name='Changed')
+
+        transfer.import_menus(data.splitlines())
+
+        self.assertEqual(Menu.objects.get(pk=self.menu.pk).name, 'Top')
+        self.assertEqual([title for title, _ in dump_tree(self.menu)], ['a', 'b'])
+        self.assertEqual(MenuItem.objects.count(), 5)
+
+    def test_invalid_input(self):
+        with self.assertRaises(transfer.MenuImportError):
+            transfer.import_menus(['{"type": "item", "id": 1, "parent": null, "fields": {}}'])
+
+        menu = '{"type": "menu", "identifier": "top", "group": null}'
+        for line in [
+            '[]',
+            '{"type": "menu", "group": null}',
+            '{"type": "menu", "identifier": "top", "fields": []}',
+            '{"type": "item", "parent": null}',
+            '{"type": "item", "id": 1, "parent": [1]}',
+            '{"type": "item", "id": 1, "parent": null, "fields": "x"}',
+        ]:
+            with self.assertRaisesRegex(transfer.MenuImportError, '^Line 2: '):
+                transfer.import_menus([menu, line])
+
+    def test_commands(self):
+        out = StringIO()
+        call_command('export_menus', '--group', 'main', stdout=out)
+        self.assertEqual(out.getvalue(), self.export())
+
+        with self.assertRaises(CommandError):
+            call_command('export_menus', '999', stdout=StringIO())
+
+
+class CloneTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group, test_field='menu')
+        make_items(self.menu, [('a', [('a1', []), ('a2', [('a21', [])])]), ('b', [])])
+        MenuItem.objects.filter(title='a21').update(test_field='extra')
+        make_items(Menu.objects.create(identifier='bottom', name='Bottom', group=self.group), [('c', [])])
+
+    def test_menu_clone(self):
+        with self.assertNumQueries(4):
+            menu = self.menu.clone(None)
+
+        self.assertEqual((menu.identifier, menu.group_id, menu.test_field), ('top', None, 'menu'))
+        self.assertEqual(dump_tree(menu), dump_tree(self.menu))
+        self.assertEqual(MenuItem.objects.get(menu=menu, title='a21').test_field, 'extra')
+
+    def test_group_clone(self):
+        group = self.group.clone('copy')
+
+        self.assertEqual(
+            list(Menu.objects.filter(group=group).order_by('identifier').values_list('identifier', flat=True)),
+            ['bottom', 'top']
+        )
+        self.assertEqual(dump_tree(Menu.objects.get(group=group, identifier='top')), dump_tree(self.menu))
+
+    def test_admin_action(self):
+        User = get_user_model()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        url = reverse('admin:{}_{}_changelist'.format(Group._meta.app_label, Group._meta.model_name))
+
+        for _ in range(2):
+            self.client.post(url, {'action': 'clone_groups', '_selected_action': [self.group.pk]})
+
+        self.assertEqual(
+            list(Group.objects.order_by('name').values_list('name', flat=True)),
+            ['main', 'main (copy 2)', 'main (copy)']
+        )
+        self.assertEqual(MenuItem.objects.count(), 18)
+
+    def test_admin_action_needs_add_permission(self):
+        from django.contrib.auth.models import Permission
+
+        user = get_user_model().objects.create_user('staff', 'staff@example.com', 'staff', is_staff=True)
+        user.user_permissions.add(Permission.objects.get(
+            content_type__app_label=Group._meta.app_label, codename='view_{}'.format(Group._meta.model_name)
+        ))
+        self.client.force_login(user)
+        url = reverse('admin:{}_{}_changelist'.format(Group._meta.app_label, Group._meta.model_name))
+
+        self.client.post(url, {'action': 'clone_groups', '_selected_action': [self.group.pk]})
+
+        self.assertEqual(Group.objects.count(), 1)
+
+    def test_admin_action_long_name(self):
+        self.group.name = 'g' * 64
+        self.group.save()
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        url = reverse('admin:{}_{}_changelist'.format(Group._meta.app_label, Group._meta.model_name))
+
+        for _ in range(2):
+            self.client.post(url, {'action': 'clone_groups', '_selected_action': [self.group.pk]})
+
+        self.assertEqual(
+            sorted(Group.objects.exclude(pk=self.group.pk).values_list('name', flat=True)),
+            ['g' * 55 + ' (copy 2)', 'g' * 57 + ' (copy)']
+        )
+
+
+class AdminTreeTest(TestCase):
+    def setUp(self):
+        self.menu = Menu.objects.create(identifier='top', name='Top')
+        make_items(self.menu, [('a', [('a1', []), ('a2', [('a21', [])])]), ('b', [])])
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+    def get_rows(self, response):
+        return [line.split('node="')[1].split('"')[0] for line in response.content.decode().splitlines() if 'node="' in line]
+
+    def titles(self, *pks):
+        return sorted(MenuItem.objects.filter(pk__in=pks).values_list('title', flat=True))
+
+    def test_change_view_renders_expanded_levels(self):
+        url = reverse('admin:test_app_menu_change', args=(self.menu.pk,))
+
+        response = self.client.get(url)
+        self.assertEqual(self.titles(*self.get_rows(response)), ['a', 'b'])
+        self.assertContains(response, 'loaded="0"', 1)
+
+        with override_settings(PLAINMENU_ADMIN_EXPANDED_DEPTH=3):
+            response = self.client.get(url)
+        self.assertEqual(len(self.get_rows(response)), 5)
+        self.assertNotContains(response, 'loaded="0"')
+
+    def test_change_view_queries_do_not_grow(self):
+        url = reverse('admin:test_app_menu_change', args=(self.menu.pk,))
+        self.client.get(url)
+
+        with override_settings(PLAINMENU_ADMIN_EXPANDED_DEPTH=3), CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+
+        MenuItem.objects.filter(menu=self.menu).delete()
+        make_items(self.menu, [(str(i), [(str(i) + 'x', [])]) for i in range(20)])
+
+        with override_settings(PLAINMENU_ADMIN_EXPANDED_DEPTH=3):
+            self.assertNumQueries(len(queries), self.client.get, url)
+
+    def test_children_view(self):
+        a2 = MenuItem.objects.get(title='a2')
+        url = reverse('admin:test_app_menu_children', args=(self.menu.pk,))
+
+        response = self.client.get(url, {'node': MenuItem.objects.get(title='a').pk})
+        self.assertEqual(self.titles(*self.get_rows(response)), ['a1', 'a2'])
+        self.assertContains(response, 'parent="{}"'.format(MenuItem.objects.get(title='a').pk), 2)
+        self.assertContains(response, 'node="{}" loaded="0"'.format(a2.pk))
+
+        response = self.client.get(url, {'node': a2.pk})
+        self.assertEqual(self.titles(*self.get_rows(response)), ['a21'])
+
+        self.assertEqual(self.client.get(url, {'node': 0}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'node': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_move_node_rejects_malformed_ids(self):
+        url = '/admin/{}/{}/{}/move/'.format(Menu._meta.app_label, Menu._meta.model_name, self.menu.pk)
+        a = MenuItem.objects.get(title='a')
+
+        self.assertEqual(self.client.post(url, {'node_id': 'x', 'sibling_id': a.pk}).status_code, 400)
+        self.assertEqual(self.client.post(url, {'node_id': a.pk, 'sibling_id': 'x'}).status_code, 400)
+
+
+class ParentChoicesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.menu = Menu.objects.create(identifier='top', name='Top')
+        make_items(self.menu, [('a', [('a1', []), ('a2', [('a21', [])])]), ('b', [])])
+        make_items(Menu.objects.create(identifier='other', name='Other'), [('x', [])])
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+    def change_url(self, title):
+        item = MenuItem.objects.get(menu=self.menu, title=title)
+        return reverse('admin:test_app_menuitem_change', args=(self.menu.pk, item.pk))
+
+    def test_choices(self):
+        response = self.client.get(self.change_url('a2'))
+        choices = [label for value, label in response.context['adminform'].form.fields['_ref_node_id'].choices]
+
+        self.assertEqual(choices[1:], ['a', '&nbsp;&nbsp;&nbsp;&nbsp;a1', 'b'])
+
+    @override_settings(PLAINMENU_CACHE='default')
+    def test_choices_are_cached(self):
+        url = self.change_url('a1')
+        self.client.get(url)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse([query for query in queries if 'title' in query['sql'] and 'ORDER BY' in query['sql']])
+
+        item = MenuItem.objects.get(title='b')
+        item.title = 'changed'
+        item.save()
+
+        self.assertContains(self.client.get(url), 'changed')
+
+    @override_settings(PLAINMENU_ADMIN_PARENT_AUTOCOMPLETE=3)
+    def test_autocomplete(self):
+        response = self.client.get(self.change_url('a'))
+        self.assertContains(response, 'plainmenu-autocomplete')
+        self.assertNotContains(response, '<option value="{}"'.format(MenuItem.objects.get(title='b').pk))
+
+        url = reverse('admin:test_app_menu_parents', args=(self.menu.pk,))
+        response = self.client.get(url, {'term': 'A', 'exclude': MenuItem.objects.get(title='a2').pk})
+        self.assertEqual([result['text'].strip() for result in response.json()['results']], ['-- root --', 'a', 'a1'])
+        self.assertEqual(response.json()['results'][0]['id'], 0)
+
+    @override_settings(PLAINMENU_ADMIN_PARENT_AUTOCOMPLETE=3)
+    def test_autocomplete_labels(self):
+        response = self.client.get(self.change_url('a'))
+        widget = response.context['adminform'].form.fields['_ref_node_id'].widget
+        self.assertIsInstance(widget, ParentAutocompleteInput)
+
+        self.assertEqual(widget.get_context('_ref_node_id', '0', {})['widget']['label'], '-- root --')
+        self.assertEqual(widget.get_context('_ref_node_id', 'junk', {})['widget']['label'], '')
+
+
+class ReorderTest(TestCase):
+    def setUp(self):
+        self.menu = Menu.objects.create(identifier='top', name='Top')
+        make_items(self.menu, [('a', [('a1', []), ('a2', [('a21', [])])]), ('b', []), ('c', [])])
+        self.other = Menu.objects.create(identifier='other', name='Other')
+        make_items(self.other, [('a', [('a1', [])])])
+
+    def pk(self, title, menu=None):
+        return MenuItem.objects.get(menu=menu or self.menu, title=title).pk
+
+    def test_reorder(self):
+        moves = [
+            (self.pk('c'), None, 0),
+            (self.pk('a21'), None, 1),
+            (self.pk('b'), self.pk('a1'), None),
+            (self.pk('a'), self.pk('a21'), 0),
+        ]
+
+        with self.assertNumQueries(5):
+            MenuItem.reorder(self.menu.pk, moves)
+
+        self.assertEqual(dump_tree(self.menu), [
+            ('c', []), ('a21', [('a', [('a1', [('b', [])]), ('a2', [])])])
+        ])
+        self.assertEqual(dump_tree(self.other), [('a', [('a1', [])])])
+
+    def test_invalid_moves(self):
+        tree = dump_tree(self.menu)
+
+        for moves in (
+            [(self.pk('a'), self.pk('a21'), 0)],
+            [(self.pk('a'), self.pk('b'), 0), (self.pk('b'), self.pk('a'), 0)],
+            [(self.pk('a'), self.pk('a', self.other), 0)],
+            [(self.pk('a'), None, -1)],
+            [(self.pk('b'), None, 0), (self.pk('b'), None, 1)],
+        ):
+            with self.assertRaises((MenuItem.DoesNotExist, InvalidMoveToDescendant, InvalidPosition)):
+                MenuItem.reorder(self.menu.pk, moves)
+
+        self.assertEqual(dump_tree(self.menu), tree)
+
+    def test_admin_endpoint(self):
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        url = reverse('admin:test_app_menu_reorder', args=(self.menu.pk,))
+
+        response = self.client.post(url, json.dumps({'items': [{'id': self.pk('c'), 'parent': None, 'position': 0}]}), content_type='application/json')
+
+        self.assertEqual([title for title, _ in dump_tree(self.menu)], ['c', 'a', 'b'])
+        self.assertEqual(response.json()['items'][0], {'id': self.pk('c'), 'parent': None, 'position': 0})
+        self.assertIn({'id': self.pk('a21'), 'parent': self.pk('a2'), 'position': 0}, response.json()['items'])
+
+        response = self.client.post(url, json.dumps({'items': [{'id': self.pk('a'), 'parent': self.pk('a1')}]}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post(url, 'nonsense', content_type='application/json').status_code, 400)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'checks sqlite query plans')
+class IndexUsageTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # 100 menus of 10 roots with 10 children with 10 children each
+        spec = [(str(i), [(str(j), [(str(k), []) for k in range(10)]) for j in range(10)]) for i in range(10)]
+        for i in range(100):
+            make_items(Menu.objects.create(identifier=str(i), name=str(i)), spec)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        cls.menu = Menu.objects.get(identifier='50')
+        cls.item = MenuItem.objects.filter(menu=cls.menu, depth=2).order_by('path')[5]
+
+    def assertUsesIndex(self, queryset, indexes=None):
+        indexes = indexes or [index.name for index in MenuItem._meta.indexes]
+        plan = queryset.explain()
+
+        self.assertNotIn('SCAN', plan, plan)
+        self.assertTrue(any(name in plan for name in indexes), plan)
+
+    def test_hot_queries_use_indexes(self):
+        self.assertEqual(MenuItem.objects.count(), 111000)
+
+        self.assertUsesIndex(self.menu.get_items())
+        self.assertUsesIndex(self.menu.menuitem_set.order_by('path'))
+        self.assertUsesIndex(self.item.get_children())
+        self.assertUsesIndex(self.item.get_siblings())
+        # get_parent() is served by the unique (path, menu) index
+        self.assertUsesIndex(MenuItem.objects.filter(path=self.item.path[:4], menu=self.menu), ['uniq'])
+
+
+@override_settings(PLAINMENU_CACHE='default')
+class MenuCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        self.items = make_items(self.menu, [('a', [('a1', [])]), ('b', [])])
+
+    def test_hit_does_not_query(self):
+        html = render("{% show_menu 'top' 'main' %}")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(render("{% show_menu 'top' 'main' %}"), html)
+
+    def test_item_change_invalidates(self):
+        render("{% show_menu 'top' 'main' %}")
+
+        item = MenuItem.objects.get(title='b')
+        item.title = 'changed'
+        item.save()
+
+        self.assertIn('changed', render("{% show_menu 'top' 'main' %}"))
+
+    def test_move_invalidates(self):
+        self.assertEqual(render("{% show_menu 'top' 'main' %}").count('<ul'), 2)
+        MenuItem.objects.get(title='a1').move(MenuItem.objects.get(title='b'), 'sorted-sibling')
+        self.assertEqual(render("{% show_menu 'top' 'main' %}").count('<ul'), 1)
+
+        MenuItem.objects.get(title='b').move(MenuItem.objects.get(title='a'), 'sorted-child')
+
+        self.assertEqual(render("{% show_menu 'top' 'main' %}").count('<ul'), 2)
+
+    def test_menu_and_group_changes_invalidate(self):
+        render("{% show_menu 'top' 'main' %}")
+        render("{% show_menu 'other' 'main' %}")
+
+        self.menu.identifier = 'other'
+        self.menu.save()
+
+        self.assertNotIn('a1', render("{% show_menu 'top' 'main' %}"))
+        self.assertIn('a1', render("{% show_menu 'other' 'main' %}"))
+
+        self.group.name = 'renamed'
+        self.group.save()
+
+        self.assertNotIn('a1', render("{% show_menu 'other' 'main' %}"))
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': False,
+        'OPTIONS': {'loaders': [
+            ('django.template.loaders.locmem.Loader', {'plainmenu/menu.html': 'custom'}),
+            'django.template.loaders.app_directories.Loader',
+        ]},
+    }])
+    def test_renderers_are_cached_apart(self):
+        fast = render("{% show_menu 'top' 'main' renderer='fast' %}")
+
+        self.assertEqual(render("{% show_menu 'top' 'main' %}"), 'custom')
+        with self.assertNumQueries(0):
+            self.assertEqual(render("{% show_menu 'top' 'main' renderer='fast' %}"), fast)
+
+    def test_item_changes_in_transaction(self):
+        with transaction.atomic():
+            for title in ('b1', 'b2'):
+                item = MenuItem.objects.get(title__startswith='b')
+                item.title = title
+                item.save()
+
+                self.assertIn(title, render("{% show_menu 'top' 'main' %}"))
+
+    def test_menu_delete_skips_item_signals(self):
+        make_items(self.menu, [('c{}'.format(i), []) for i in range(200)], parent_path='0005')
+        render("{% show_menu 'top' 'main' %}")
+
+        # items are selected and deleted in batches, the menu invalidates once
+        with self.assertNumQueries(5):
+            self.menu.delete()
+
+        self.assertNotIn('a1', render("{% show_menu 'top' 'main' %}"))
+
+        with override_settings(PLAINMENU_CACHE=None):
+            menu = Menu.objects.create(identifier='other')
+            make_items(menu, [('c{}'.format(i), []) for i in range(200)])
+
+            with self.assertNumQueries(2):
+                menu.delete()
+
+    def test_cache_disabled_per_call(self):
+        render("{% show_menu 'top' 'main' %}")
+
+        with self.assertNumQueries(3):
+            render("{% show_menu 'top' 'main' cache=False %}")
+
+
+@override_settings(PLAINMENU_CACHE='default', PLAINMENU_LRU_SIZE=2)
+class TreeCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [('a', [('a1', [])]), ('b', [])])
+
+    def test_tree_is_kept_in_memory(self):
+        html = render("{% show_menu 'top' 'main' %}")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(render("{% show_menu 'top' 'main' %}"), html)
+
+        tree = menu_cache.get_tree_cache().get(('top', 'main'), menu_cache.get_versions([('top', 'main')])[('top', 'main')])
+        self.assertIsInstance(tree[0], MenuNode)
+        with self.assertRaises(AttributeError):
+            tree[0].title = 'changed'
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': False,
+        'OPTIONS': {'loaders': [
+            ('django.template.loaders.locmem.Loader', {
+                'custom.html': '{% for item in items %}[{{ item.title }}:{{ item.menu.identifier }}]{% endfor %}',
+            }),
+            'django.template.loaders.app_directories.Loader',
+        ]},
+    }])
+    def test_custom_template_gets_items(self):
+        self.assertEqual(render("{% show_menu 'top' 'main' template='custom.html' %}"), '[a:top][b:top]')
+        self.assertEqual(menu_cache.get_tree_cache().keys(), [])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(render("{% show_menu 'top' 'main' template='custom.html' %}"), '[a:top][b:top]')
+
+    def test_versions_of_other_menus_are_not_fetched(self):
+        make_items(Menu.objects.create(identifier='other', group=self.group), [('c', [])])
+        render("{% show_menu 'other' 'main' %}")
+
+        request = RequestFactory().get('/')
+        render("{% show_menu 'top' 'main' %}", request=request)
+
+        self.assertEqual(list(request._plainmenu_versions), [('top', 'main')])
+
+    @override_settings(PLAINMENU_RENDER_EXTRA_FIELDS=('test_field',), TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': False,
+        'OPTIONS': {'loaders': [
+            ('django.template.loaders.locmem.Loader', {
+                'crumbs.html': '{% for item in items %}[{{ item.title }}:{{ item.test_field }}]{% endfor %}',
+            }),
+            'django.template.loaders.app_directories.Loader',
+        ]},
+    }])
+    def test_extra_fields_are_kept(self):
+        MenuItem.objects.filter(title__startswith='a').update(test_field='X')
+
+        tree = freeze(self.menu.get_tree())
+        self.assertEqual(tree[0].children[0].test_field, 'X')
+        self.assertEqual(pickle.loads(pickle.dumps(tree))[0].children[0].test_field, 'X')
+        self.assertEqual(tree[0].menu_id, self.menu.pk)
+        with self.assertRaises(AttributeError):
+            tree[0].missing
+
+        render("{% show_menu 'top' 'main' active='/a1/' %}")
+
+        with self.assertNumQueries(0):
+            html = render("{% show_breadcrumbs 'top' 'main' url='/a1/' template='crumbs.html' %}")
+        self.assertEqual(html, '[a:X][a1:X]')
+
+    def test_version_change_drops_stale_tree(self):
+        render("{% show_menu 'top' 'main' %}")
+
+        # as if changed by another process
+        MenuItem.objects.filter(title='b').update(title='changed')
+        menu_cache.invalidate('top', 'main')
+
+        self.assertIn('changed', render("{% show_menu 'top' 'main' %}"))
+
+    def test_versions_are_fetched_once_per_request(self):
+        request = RequestFactory().get('/')
+        render("{% show_menu 'top' 'main' %}", request=request)
+
+        MenuItem.objects.filter(title='b').update(title='changed')
+        menu_cache.invalidate('top', 'main')
+
+        self.assertNotIn('changed', render("{% show_menu 'top' 'main' %}", request=request))
+        self.assertEqual(list(request._plainmenu_versions), [('top', 'main')])
+        self.assertIn('changed', render("{% show_menu 'top' 'main' %}"))
+
+
+@override_settings(PLAINMENU_CACHE='default')
+class WarmCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(name='main')
+        self.menu = Menu.objects.create(identifier='top', name='Top', group=self.group)
+        make_items(self.menu, [('a', [('a1', [])]), ('b', [])])
+
+    def test_command(self):
+        with override_settings(PLAINMENU_CACHE=None):
+            expected = render("{% show_menu 'top' 'main' %}")
+
+        call_command('warm_menu_cache', stdout=StringIO())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(render("{% show_menu 'top' 'main' %}"), expected)
+            render("{% show_menu 'top' 'main' active='/a1/' %}")
+            render("{% show_breadcrumbs 'top' 'main' url='/a1/' %}")
+            self.client.get(reverse('plainmenu_menu_json', kwargs={'group': 'main', 'identifier': 'top'}))
+
+    @override_settings(PLAINMENU_WARM_ON_SAVE=True)
+    def test_warm_on_commit(self):
+        MenuItem.objects.filter(title='b').update(title='changed')
+        menu_cache.invalidate_menu(self.menu)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            warm.warm_on_commit(self.menu.pk)
+
+        with self.assertNumQueries(0):
+            self.assertIn('changed', render("{% show_menu 'top' 'main' %}"))
+
+    @override_settings(PLAINMENU_REBUILD_WAIT=0)
+    def test_single_flight(self):
+        old = render("{% show_menu 'top' 'main' %}")
+        menu_cache.invalidate_menu(self.menu)
+
+        version = menu_cache.get_rendered('top', 'main', None)[1]
+        lock = menu_cache.acquire_rebuild(('top', 'main', None, None), version)
+        self.assertIsNotNone(lock)
+
+        # another worker is rebuilding, the previous version is served meanwhile
+        with self.assertNumQueries(0):
+            self.assertEqual(render("{% show_menu 'top' 'main' %}"), old)
+
+        menu_cache.release_rebuild(lock)
+        MenuItem.objects.filter(title='b').update(title='changed')
+        self.assertIn('changed', render("{% show_menu 'top' 'main' %}"))
+
+
+class LRUCacheTest(TestCase):
+    def test_eviction(self):
+        lru = LRUCache(2, max_bytes=100)
+        lru.set('a', 1, 'A', 10)
+        lru.set('b', 1, 'B', 10)
+        lru.get('a', 1)
+        lru.set('c', 1, 'C', 10)
+
+        self.assertEqual(sorted(lru.keys()), ['a', 'c'])
+
+        lru.set('d', 1, 'D', 95)
+        self.assertEqual(lru.keys(), ['d'])
+        self.assertEqual(lru.size, 95)
+
+    def test_version_mismatch(self):
+        lru = LRUCache(2)
+        lru.set('a', 1, 'A')
+
+        self.assertIsNone(lru.get('a', 2))
+        self.assertNotIn('a', lru)
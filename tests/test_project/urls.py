@@ -11,4 +11,5 @@ Menu = swapper.load_model('plainmenu', 'Menu')
 urlpatterns = [
     url(r'^$', ListView.as_view(template_name='index.html', model=Menu)),
     url(r'^admin/', admin.site.urls),
+    url(r'^menus/', include('plainmenu.urls')),
 ]